@@ -5,16 +5,22 @@ import math
 
 __version__ = "260318.1"
 
+from .ec_broker import *
 from .ec_classes import *
 from .ec_compiler import *
 from .ec_condition import *
 from .ec_core import *
 from .ec_handler import *
+from .ec_http import *
 from .ec_mqtt import *
+from .ec_process import *
 from .ec_program import *
 from .ec_psutil import *
+from .ec_save import *
+from .ec_ssh import *
 from .ec_timestamp import *
 from .ec_value import *
+from .ec_watch import *
 
 _LAZY_MODULES = (
 	'ec_border',
@@ -0,0 +1,289 @@
+import sys, socket, struct, threading, time
+
+__all__ = ['LocalBroker']
+
+# MQTT control packet types
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+# Test whether a topic matches a subscription filter, which may contain
+# '+' (one level) and '#' (all remaining levels) wildcards
+def topicMatches(filter, topic):
+    filterParts = filter.split('/')
+    topicParts = topic.split('/')
+    for n, part in enumerate(filterParts):
+        if part == '#':
+            return True
+        if n >= len(topicParts):
+            return False
+        if part != '+' and part != topicParts[n]:
+            return False
+    return len(filterParts) == len(topicParts)
+
+def encodeLength(length):
+    data = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length > 0: byte |= 0x80
+        data.append(byte)
+        if length == 0: return bytes(data)
+
+def encodeString(text):
+    data = text.encode('utf-8')
+    return struct.pack('!H', len(data)) + data
+
+def makePacket(type, flags, body):
+    return bytes([(type << 4) | flags]) + encodeLength(len(body)) + body
+
+###############################################################################
+# One client connection to the broker
+class BrokerSession():
+    def __init__(self, broker, sock):
+        self.broker = broker
+        self.sock = sock
+        self.version = 4
+        self.clientID = ''
+        self.subscriptions = {}
+        self.nextID = 0
+        self.sendLock = threading.Lock()
+        self.open = True
+
+    def send(self, data):
+        with self.sendLock:
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                self.open = False
+
+    def recvExactly(self, count):
+        data = bytearray()
+        while len(data) < count:
+            chunk = self.sock.recv(count - len(data))
+            if not chunk: raise EOFError()
+            data.extend(chunk)
+        return bytes(data)
+
+    def readPacket(self):
+        first = self.recvExactly(1)[0]
+        length = 0
+        multiplier = 1
+        while True:
+            byte = self.recvExactly(1)[0]
+            length += (byte & 0x7f) * multiplier
+            multiplier *= 128
+            if not byte & 0x80: break
+        return first >> 4, first & 0x0f, self.recvExactly(length)
+
+    # Skip the properties section of an MQTT 5 packet
+    def skipProperties(self, body, offset):
+        if self.version < 5: return offset
+        length = 0
+        multiplier = 1
+        while True:
+            byte = body[offset]
+            offset += 1
+            length += (byte & 0x7f) * multiplier
+            multiplier *= 128
+            if not byte & 0x80: break
+        return offset + length
+
+    def properties(self):
+        return b'\x00' if self.version >= 5 else b''
+
+    def run(self):
+        try:
+            while self.open:
+                type, flags, body = self.readPacket()
+                if type == CONNECT: self.onConnect(body)
+                elif type == PUBLISH: self.onPublish(flags, body)
+                elif type == PUBREL:
+                    self.send(makePacket(PUBCOMP, 0, body[:2]))
+                elif type == PUBREC:
+                    self.send(makePacket(PUBREL, 2, body[:2]))
+                elif type == SUBSCRIBE: self.onSubscribe(body)
+                elif type == UNSUBSCRIBE: self.onUnsubscribe(body)
+                elif type == PINGREQ:
+                    self.send(makePacket(PINGRESP, 0, b''))
+                elif type == DISCONNECT:
+                    break
+        except (EOFError, OSError, IndexError, struct.error):
+            pass
+        self.open = False
+        self.broker.remove(self)
+        try: self.sock.close()
+        except OSError: pass
+
+    def onConnect(self, body):
+        nameLength = struct.unpack_from('!H', body, 0)[0]
+        offset = 2 + nameLength
+        self.version = body[offset]
+        offset += 4 # version, flags and keep alive
+        offset = self.skipProperties(body, offset)
+        idLength = struct.unpack_from('!H', body, offset)[0]
+        self.clientID = body[offset + 2:offset + 2 + idLength].decode('utf-8', errors='replace')
+        self.send(makePacket(CONNACK, 0, b'\x00\x00' + self.properties()))
+
+    def onPublish(self, flags, body):
+        qos = (flags >> 1) & 3
+        retain = flags & 1
+        topicLength = struct.unpack_from('!H', body, 0)[0]
+        topic = body[2:2 + topicLength].decode('utf-8', errors='replace')
+        offset = 2 + topicLength
+        packetID = None
+        if qos > 0:
+            packetID = body[offset:offset + 2]
+            offset += 2
+        offset = self.skipProperties(body, offset)
+        payload = body[offset:]
+        if qos == 1:
+            self.send(makePacket(PUBACK, 0, packetID)) # type: ignore
+        elif qos == 2:
+            self.send(makePacket(PUBREC, 0, packetID)) # type: ignore
+        self.broker.publish(topic, payload, qos, retain)
+
+    def onSubscribe(self, body):
+        packetID = body[:2]
+        offset = self.skipProperties(body, 2)
+        granted = bytearray()
+        topics = []
+        while offset < len(body):
+            length = struct.unpack_from('!H', body, offset)[0]
+            filter = body[offset + 2:offset + 2 + length].decode('utf-8', errors='replace')
+            qos = body[offset + 2 + length] & 3
+            offset += 3 + length
+            self.subscriptions[filter] = qos
+            granted.append(qos)
+            topics.append(filter)
+        self.send(makePacket(SUBACK, 0, packetID + self.properties() + bytes(granted)))
+        for filter in topics:
+            self.broker.sendRetained(self, filter)
+
+    def onUnsubscribe(self, body):
+        packetID = body[:2]
+        offset = self.skipProperties(body, 2)
+        codes = bytearray()
+        while offset < len(body):
+            length = struct.unpack_from('!H', body, offset)[0]
+            filter = body[offset + 2:offset + 2 + length].decode('utf-8', errors='replace')
+            offset += 2 + length
+            self.subscriptions.pop(filter, None)
+            codes.append(0)
+        self.send(makePacket(UNSUBACK, 0, packetID + (self.properties() + bytes(codes) if self.version >= 5 else b'')))
+
+    # The highest QoS with which this session subscribes to a topic, or None
+    def matchQoS(self, topic):
+        best = None
+        for filter, qos in list(self.subscriptions.items()):
+            if topicMatches(filter, topic) and (best is None or qos > best):
+                best = qos
+        return best
+
+    def deliver(self, topic, payload, qos, retain=0):
+        body = encodeString(topic)
+        if qos > 0:
+            with self.sendLock:
+                self.nextID = self.nextID % 65535 + 1
+                packetID = self.nextID
+            body += struct.pack('!H', packetID)
+        body += self.properties() + payload
+        self.send(makePacket(PUBLISH, (qos << 1) | retain, body))
+
+###############################################################################
+# A minimal MQTT 3.1.1 and 5 broker that runs in the current process. It is
+# meant as a stand-in for a real broker when testing and benchmarking, and
+# supports subscriptions with wildcards, QoS 0 to 2 and retained messages,
+# but not persistent sessions, authentication or TLS.
+class LocalBroker():
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self.sessions = []
+        self.retained = {}
+        self.lock = threading.Lock()
+        self.server = None
+        self.published = 0
+
+    # Start listening. With a port of 0 a free port is chosen; it is
+    # available in self.port afterwards
+    def start(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((self.host, self.port))
+        server.listen(64)
+        self.port = server.getsockname()[1]
+        self.server = server
+        threading.Thread(target=self.accept, daemon=True).start()
+        return self
+
+    def accept(self):
+        while self.server is not None:
+            try:
+                sock, _ = self.server.accept()
+            except OSError:
+                break
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            session = BrokerSession(self, sock)
+            with self.lock:
+                self.sessions.append(session)
+            threading.Thread(target=session.run, daemon=True).start()
+
+    def remove(self, session):
+        with self.lock:
+            if session in self.sessions: self.sessions.remove(session)
+
+    def publish(self, topic, payload, qos, retain=0):
+        with self.lock:
+            self.published += 1
+            if retain:
+                if payload: self.retained[topic] = (payload, qos)
+                else: self.retained.pop(topic, None)
+            sessions = list(self.sessions)
+        for session in sessions:
+            subscribed = session.matchQoS(topic)
+            if subscribed is not None:
+                session.deliver(topic, payload, min(qos, subscribed))
+
+    def sendRetained(self, session, filter):
+        with self.lock:
+            retained = list(self.retained.items())
+        for topic, (payload, qos) in retained:
+            if topicMatches(filter, topic):
+                session.deliver(topic, payload, min(qos, session.subscriptions[filter]), 1)
+
+    # Drop every client connection, as a broker restart would
+    def disconnectAll(self):
+        with self.lock:
+            sessions = list(self.sessions)
+        for session in sessions:
+            session.open = False
+            try: session.sock.shutdown(socket.SHUT_RDWR)
+            except OSError: pass
+
+    def stop(self):
+        server = self.server
+        self.server = None
+        if server is not None: server.close()
+        self.disconnectAll()
+
+# Run a broker on its own, for scripts to connect to: python -m easycoder.ec_broker [port]
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 1883
+    broker = LocalBroker(port=port).start()
+    print(f'Local MQTT broker listening on {broker.host}:{broker.port}')
+    try:
+        while True: time.sleep(1)
+    except KeyboardInterrupt:
+        broker.stop()
@@ -1,5 +1,8 @@
-import sys, paramiko, json
+import sys, os, json, random, sqlite3, atexit, mmap
+from array import array
+from collections import OrderedDict
 from typing import Optional, Any, Union
+from .ec_ssh import sshPool
 
 ###############################################################################
 # Type normalization: support both Python types and string type names
@@ -33,6 +36,18 @@ def type_in(t: Union[type, str, None], types: tuple) -> bool:
 			return True
 	return False
 
+# Characters that can start a JSON document (after optional whitespace)
+JSON_START = frozenset('{["-0123456789tfn \t\r\n')
+
+def decode_json_value(value: Any) -> Any:
+	"""Decode a string holding JSON, or return the value unchanged."""
+	if not isinstance(value, str) or value[:1] not in JSON_START:
+		return value
+	try:
+		return json.loads(value)
+	except Exception:
+		return value
+
 class FatalError(BaseException):
 	def __init__(self, compiler, message):
 		compiler.showWarnings()
@@ -160,6 +175,54 @@ class ECValue():
     def isLocked(self):
         return self.locked
 
+###############################################################################
+# A lazy view of a string split on a separator, used as the element list of
+# a variable. Parts are located and wrapped as ECValues only when indexed.
+class ECSplitView():
+    def __init__(self, text: str, separator: str):
+        if separator == '':
+            raise ValueError('empty separator')
+        self.text = text
+        self.separator = separator
+        self.length = text.count(separator) + 1
+        self.offsets = array('q', [0])  # Start offsets of the parts located so far
+        self.items = {}  # Parts that have been materialised or assigned
+
+    def __len__(self):
+        return self.length
+
+    # Get the start offset of a part, scanning forward as far as needed
+    def start(self, n):
+        offsets = self.offsets
+        text = self.text
+        separator = self.separator
+        size = len(separator)
+        while len(offsets) <= n:
+            offsets.append(text.index(separator, offsets[-1]) + size)
+        return offsets[n]
+
+    def __getitem__(self, n):
+        if n < 0: n += self.length
+        if n < 0 or n >= self.length:
+            raise IndexError('split index out of range')
+        item = self.items.get(n)
+        if item is None:
+            start = self.start(n)
+            end = self.start(n + 1) - len(self.separator) if n < self.length - 1 else len(self.text)
+            item = ECValue(type=str, content=self.text[start:end])
+            self.items[n] = item
+        return item
+
+    def __setitem__(self, n, value):
+        if n < 0: n += self.length
+        if n < 0 or n >= self.length:
+            raise IndexError('split index out of range')
+        self.items[n] = value
+
+    def __iter__(self):
+        for n in range(self.length):
+            yield self[n]
+
 ###############################################################################
 # The base class for all EasyCoder variable types
 class ECObject():
@@ -205,8 +268,16 @@ class ECObject():
     def getValues(self):
         return self.values
 
+    # Replace the values with a lazy split of a string
+    def setSplit(self, text, separator):
+        self.values = ECSplitView(text, separator) # type: ignore
+        self.elements = len(self.values)
+        self.index = 0
+
     # Set the number of elements in the variable
     def setElements(self, elements):
+        if isinstance(self.values, ECSplitView):
+            self.values = list(self.values)
         if self.elements == 0:
             self.values = [None] * elements
             self.elements = elements
@@ -338,8 +409,8 @@ class ECVariable(ECValueHolder):
         val_type = value.getType()
         if type_in(val_type, ('dict', 'list')):
              value.setContent(json.dumps(value.getContent()))
-        elif not type_in(val_type, (str, int, float, bool, None)):
-            raise RuntimeError(None, 'ECVariable can only hold str, int, float, or bool values') # type: ignore
+        elif not type_in(val_type, (str, int, float, bool, 'bytes', None)):
+            raise RuntimeError(None, 'ECVariable can only hold str, int, float, bool or bytes values') # type: ignore
         super().setValue(value)
     
     # Check if the variable is empty
@@ -381,17 +452,12 @@ class ECDictionary(ECValueHolder):
     def getValue(self):
         return super().getValue()
     
-    # Set an entry in the dictionary
+    # Set an entry in the dictionary. The backing dict is updated in place
     def setEntry(self, key, value):
         content = self.getValue()
         if content is None:
             return
-        if isinstance(value, str):
-             try:
-                 value = json.loads(value)
-             except Exception:
-                 pass
-        content[key] = value # type: ignore
+        content[key] = decode_json_value(value) # type: ignore
     
     # Test if an entry exists in the dictionary
     def hasEntry(self, key):
@@ -418,6 +484,16 @@ class ECDictionary(ECValueHolder):
         if key in content:
             del content[key]
     
+    # The properties of a dictionary are its entries
+    def setProperty(self, name, value):
+        self.setEntry(name, value)
+
+    def hasProperty(self, name):
+        return self.hasEntry(name)
+
+    def getProperty(self, name):
+        return self.getEntry(name)
+
     # Get the keys of the dictionary
     def keys(self):
         content = self.getValue()
@@ -429,11 +505,170 @@ class ECDictionary(ECValueHolder):
     def isEmpty(self):
         return len(self.keys()) == 0
 
+###############################################################################
+# A dictionary variable held in a local SQLite database. Writes are batched
+# into transactions and recently used entries are kept in a small cache.
+class ECStore(ECDictionary):
+    DELETED = object()
+
+    def __init__(self):
+        self.connection = None
+        self.path = None
+        self.cacheSize = 1000
+        self.batchSize = 100
+        self.cache = OrderedDict()
+        self.pending = {}
+        super().__init__()
+
+    # Open (or create) the database file
+    def open(self, path, cacheSize=None, batchSize=None):
+        self.close()
+        if cacheSize is not None: self.cacheSize = int(cacheSize)
+        if batchSize is not None: self.batchSize = int(batchSize)
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT)')
+        self.connection.commit()
+        atexit.register(self.close)
+
+    # Write any pending changes and close the database
+    def close(self):
+        if self.connection is None:
+            return
+        self.flush()
+        self.connection.close()
+        self.connection = None
+        self.cache.clear()
+        atexit.unregister(self.close)
+
+    def isOpen(self):
+        return self.connection is not None
+
+    def checkOpen(self):
+        if self.connection is None:
+            raise RuntimeError(None, f'Store {self.name} is not open') # type: ignore
+
+    # Write the pending changes in a single transaction
+    def flush(self):
+        if not self.pending or self.connection is None:
+            return
+        updates = []
+        deletions = []
+        for key, value in self.pending.items():
+            if value is ECStore.DELETED: deletions.append((key,))
+            else: updates.append((key, json.dumps(value)))
+        with self.connection:
+            if updates:
+                self.connection.executemany('INSERT OR REPLACE INTO entries (key, value) VALUES (?, ?)', updates)
+            if deletions:
+                self.connection.executemany('DELETE FROM entries WHERE key = ?', deletions)
+        self.pending.clear()
+
+    # Record a change, flushing when the batch is full
+    def write(self, key, value):
+        self.pending[key] = value
+        if len(self.pending) >= self.batchSize:
+            self.flush()
+
+    # Add an entry to the cache, evicting the least recently used
+    def remember(self, key, value):
+        self.cache[key] = value
+        self.cache.move_to_end(key)
+        if len(self.cache) > self.cacheSize:
+            self.cache.popitem(last=False)
+
+    # Look up an entry, returning DELETED if it is not present
+    def lookup(self, key):
+        self.checkOpen()
+        key = str(key)
+        if key in self.pending:
+            return self.pending[key]
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        row = self.connection.execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone() # type: ignore
+        if row is None:
+            return ECStore.DELETED
+        value = json.loads(row[0])
+        self.remember(key, value)
+        return value
+
+    # Reset the store to empty
+    def reset(self):
+        if self.connection is None:
+            return
+        self.pending.clear()
+        self.cache.clear()
+        with self.connection:
+            self.connection.execute('DELETE FROM entries')
+
+    # Replace the whole content of the store
+    def setValue(self, value):
+        if self.connection is None:
+            return f'Store {self.name} is not open'
+        error = super().setValue(value)
+        if error != None:
+            return error
+        content = ECObject.getValue(self)
+        ECObject.setValue(self, None)
+        self.reset()
+        with self.connection:
+            self.connection.executemany('INSERT INTO entries (key, value) VALUES (?, ?)',
+                [(str(key), json.dumps(item)) for key, item in content.items()]) # type: ignore
+        return None
+
+    # Get the whole content of the store as a dict
+    def getValue(self):
+        self.checkOpen()
+        self.flush()
+        rows = self.connection.execute('SELECT key, value FROM entries') # type: ignore
+        return {key: json.loads(value) for key, value in rows}
+
+    # Set an entry in the store
+    def setEntry(self, key, value):
+        self.checkOpen()
+        if isinstance(value, ECValue): value = value.getContent()
+        key = str(key)
+        value = decode_json_value(value)
+        self.write(key, value)
+        self.remember(key, value)
+
+    # Test if an entry exists in the store
+    def hasEntry(self, key):
+        return self.lookup(key) is not ECStore.DELETED
+
+    # Get an entry from the store
+    def getEntry(self, key):
+        value = self.lookup(key)
+        if value is ECStore.DELETED:
+            raise RuntimeError(None, f"Key '{key}' not found in {self.name}") # type: ignore
+        return value
+
+    # Delete an entry from the store
+    def deleteEntry(self, key):
+        self.checkOpen()
+        key = str(key)
+        self.cache.pop(key, None)
+        self.write(key, ECStore.DELETED)
+
+    # Get the keys of the store
+    def keys(self):
+        self.checkOpen()
+        self.flush()
+        return [row[0] for row in self.connection.execute('SELECT key FROM entries')] # type: ignore
+
+    # Check if the store is empty
+    def isEmpty(self):
+        self.checkOpen()
+        self.flush()
+        return self.connection.execute('SELECT 1 FROM entries LIMIT 1').fetchone() is None # type: ignore
+
 ###############################################################################
 # A list variable
 class ECList(ECValueHolder):
     def __init__(self):
         super().__init__()
+        self.lookup = None
         self.reset()
 
     # Reset the object to empty state
@@ -449,35 +684,64 @@ class ECList(ECValueHolder):
                 content = json.loads(content) # type: ignore
             except:
                 pass
+        self.lookup = None
         super().setValue(content)
     
     def getValue(self):
         return super().getValue()
+
+    # Convert an incoming item to the form in which it is stored
+    def normalise(self, item):
+        return decode_json_value(item)
+
+    # Get the key under which an item is held in the lookup index
+    def lookupKey(self, item):
+        try:
+            hash(item)
+            return item
+        except TypeError:
+            return ('json', json.dumps(item, sort_keys=True))
+
+    # Get the lookup index for the current list, building it if necessary.
+    # The index maps each item to the position of its first occurrence.
+    def getLookup(self):
+        content = self.getContent()
+        if content is None:
+            return None
+        if self.lookup is None or self.lookup[0] is not content:
+            index = {}
+            for n, item in enumerate(content):
+                index.setdefault(self.lookupKey(item), n)
+            self.lookup = (content, index)
+        return self.lookup[1]
+
+    # Discard the lookup index (used when items move or are replaced)
+    def invalidateLookup(self):
+        self.lookup = None
+
+    # Set the content, which may be the same list changed in place
+    def setContent(self, content):
+        self.invalidateLookup()
+        super().setContent(content)
     
-    # Append an item to the list
+    # Append an item to the list. The list is changed in place, so the
+    # lookup index can be kept up to date rather than discarded.
     def append(self, item):
         content = self.getContent()
         if content is None:
             return
-        if isinstance(item, str):
-             try:
-                 item = json.loads(item)
-             except Exception:
-                  pass
+        item = self.normalise(item)
         content.append(item) # type: ignore
-        self.setContent(content)
+        if self.lookup is not None and self.lookup[0] is content:
+            self.lookup[1].setdefault(self.lookupKey(item), len(content) - 1)
     
     # Set an item in the list
     def setItem(self, index, value):
         content = self.getValue()
         if content is None:
             return
-        if isinstance(value, str):
-             try:
-                 value = json.loads(value)
-             except Exception:
-                 pass
-        content[index] = value # type: ignore
+        content[index] = self.normalise(value) # type: ignore
+        self.invalidateLookup()
     
     # Return the number of items in the list
     def getItemCount(self):
@@ -492,6 +756,20 @@ class ECList(ECValueHolder):
         if content is None:
             return None
         return content[index]
+
+    # Test if the list holds a given item
+    def includes(self, item):
+        lookup = self.getLookup()
+        if lookup is None:
+            return False
+        return self.lookupKey(self.normalise(item)) in lookup
+
+    # Get the position of the first occurrence of an item, or -1
+    def getIndexOf(self, item):
+        lookup = self.getLookup()
+        if lookup is None:
+            return -1
+        return lookup.get(self.lookupKey(self.normalise(item)), -1)
     
     # Check if the list is empty
     def isEmpty(self):
@@ -505,7 +783,68 @@ class ECList(ECValueHolder):
         if index < 0 or index >= len(content):
             return
         del content[index]
-        self.setContent(content)
+        self.invalidateLookup()
+
+    # Put the items in a random order
+    def shuffle(self):
+        content = self.getContent()
+        if content is None:
+            return
+        random.shuffle(content) # type: ignore
+        self.invalidateLookup()
+
+###############################################################################
+# A string builder variable. Appended text is held as a list of parts,
+# which are only joined when the value is needed
+class ECBuilder(ECValueHolder):
+    def __init__(self):
+        super().__init__()
+        self.reset()
+
+    # Reset the object to an empty string
+    def reset(self):
+        self.setValue(ECValue(type=str, content=''))
+
+    # Set the value to an ECValue, discarding any existing parts
+    def setValue(self, value):
+        content = value.getContent() if isinstance(value, ECValue) else value
+        if content in ('', None): parts = []
+        elif isinstance(content, (dict, list)): parts = [json.dumps(content)]
+        else: parts = [str(content)]
+        super().setValue(parts)
+
+    # Get the list of parts at the current index
+    def getParts(self):
+        return super().getValue()
+
+    # Append some text
+    def append(self, item):
+        if item is None:
+            return
+        if isinstance(item, (dict, list)): item = json.dumps(item)
+        self.getParts().append(str(item)) # type: ignore
+
+    # Join the parts, keeping the result as the only part
+    def getText(self):
+        parts = self.getParts()
+        if not parts:
+            return ''
+        if len(parts) > 1:
+            parts[:] = [''.join(parts)]
+        return parts[0]
+
+    # Get the value as a string ECValue
+    def getValue(self):
+        return ECValue(type=str, content=self.getText())
+
+    # Check if the builder is empty
+    def isEmpty(self):
+        for part in self.getParts(): # type: ignore
+            if part: return False
+        return True
+
+    def textify(self):
+        return self.getText()
 
 ###############################################################################
 # A queue variable
@@ -520,6 +859,7 @@ class ECQueue(ECList):
     # Pop the first ECValue from the queue
     def pop(self):
         content = self.getContent()
+        self.invalidateLookup()
         return content.pop(0) # type: ignore
 
 ###############################################################################
@@ -535,6 +875,7 @@ class ECStack(ECList):
     # Pop the most recent ECValue from the stack
     def pop(self):
         content = self.getContent()
+        self.invalidateLookup()
         return content.pop() # type: ignore
 
 ###############################################################################
@@ -542,6 +883,65 @@ class ECStack(ECList):
 class ECFile(ECObject):
     def __init__(self):
         super().__init__()
+        self.handle = None
+        self.mapping = None
+        self.position = 0
+
+    # Map a file into memory, read-only. Only the pages that are used get
+    # loaded, so a large file can be searched without reading it all
+    def map(self, path):
+        self.unmap()
+        self.handle = open(path, 'rb')
+        if os.fstat(self.handle.fileno()).st_size > 0:
+            self.mapping = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # An empty file can't be mapped
+            self.mapping = b''
+        self.position = 0
+
+    def unmap(self):
+        if isinstance(self.mapping, mmap.mmap): self.mapping.close()
+        if self.handle is not None: self.handle.close()
+        self.mapping = None
+        self.handle = None
+
+    def isMapped(self):
+        return self.mapping is not None
+
+    # The size of the mapped file in bytes
+    def getSize(self):
+        return len(self.mapping) # type: ignore
+
+    # Get the text between two byte offsets
+    def getText(self, start=0, end=None):
+        return self.mapping[start:end].decode('utf-8', errors='replace') # type: ignore
+
+    # Find the byte offset of some text, or -1
+    def find(self, text, last=False):
+        needle = text.encode('utf-8')
+        return self.mapping.rfind(needle) if last else self.mapping.find(needle) # type: ignore
+
+    # Count the lines, a block at a time
+    def countLines(self, blockSize=1048576):
+        mapping = self.mapping
+        size = len(mapping) # type: ignore
+        count = 0
+        for start in range(0, size, blockSize):
+            count += mapping[start:start + blockSize].count(b'\n') # type: ignore
+        if size > 0 and mapping[size - 1:size] != b'\n': count += 1 # type: ignore
+        return count
+
+    # Read the next line, without its line ending, or None at the end
+    def readLine(self):
+        mapping = self.mapping
+        start = self.position
+        if start >= len(mapping): return None # type: ignore
+        end = mapping.find(b'\n', start) # type: ignore
+        if end < 0: end = len(mapping) # type: ignore
+        self.position = end + 1
+        # A CRLF line ending leaves a '\r' before the '\n'
+        if end > start and mapping[end - 1] == 13: end -= 1 # type: ignore
+        return mapping[start:end].decode('utf-8', errors='replace') # type: ignore
 
 ###############################################################################
 # A module variable
@@ -558,19 +958,26 @@ class ECModule(ECObject):
 class ECSSH(ECObject):
     def __init__(self):
         super().__init__()
+        self.key = None
 
-    # Set up the SSH connection
-    def setup(self, host=None, user=None, password=None):
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    # Set up the SSH connection, reusing a pooled one to the same host and user
+    def setup(self, host=None, user=None, password=None, port=22):
         try:
-            ssh.connect(host, username=user, password=password, timeout=10) # type: ignore
-            self.setValue(ssh)
-            self.sftp = ssh.open_sftp()
+            self.key = sshPool.connect(host, user, password, port)
             return True
-        except:
+        except Exception:
+            self.key = None
             return False
-    
+
+    # Release the connection. It stays in the pool until it has been idle
+    # for a while
+    def close(self):
+        self.key = None
+
     # Get the SFTP client
     def getSFTP(self):
-        return self.sftp
+        return sshPool.getSFTP(self.key)
+
+    # Run an action on the SFTP client, reconnecting if the connection dropped
+    def call(self, action):
+        return sshPool.call(self.key, action)
@@ -1,5 +1,6 @@
-import json, math, hashlib, threading, os, subprocess, time
-import base64, binascii, random, requests, paramiko, uuid
+import json, math, hashlib, threading, os, time
+import base64, binascii, random, uuid
+from collections import deque
 from copy import deepcopy
 from datetime import datetime
 from pathlib import Path
@@ -13,7 +14,9 @@ from .ec_classes import (
     ECObject,
     ECVariable,
     ECDictionary,
+    ECStore,
     ECList,
+    ECBuilder,
     ECQueue,
     ECFile,
     ECStack,
@@ -23,15 +26,64 @@ from .ec_classes import (
 )
 
 from .ec_handler import Handler
+from .ec_http import HTTPPool
+from .ec_process import ProcessManager
+from .ec_save import FileSaver, getEncoder, replacing
+from .ec_ssh import sftpReadText, sftpWriteText
+from .ec_watch import FileWatcher
+
+errorCode = 0
+errorReason = ''
 
 class Core(Handler):
 
     def __init__(self, compiler):
         super().__init__(compiler)
         self.encoding = 'utf-8'
+        self.http = None
+        self.saver = None
+        self.processes = None
+        self.watcher = None
+        self.changes = {}
+        self.changedFile = ''
+        self.systemResults = {}
+        self.urlResults = {}
+        self.outputLines = {}
+        self.line = ''
+        self.responses = {}
+        self.response = None
 
     def getName(self):
         return 'core'
+
+    # If a value is a file variable that has been loaded, return the file
+    def getMappedFile(self, value):
+        if isinstance(value, ECValue) and value.getType() == 'symbol':
+            object = self.getObject(self.getVariable(value.name))
+            if isinstance(object, ECFile) and object.isMapped():
+                return object
+        return None
+
+    # Get the HTTP session pool shared by get, post and download
+    def getHTTP(self):
+        if self.http is None:
+            self.http = HTTPPool()
+        return self.http
+
+    def getProcesses(self):
+        if self.processes is None:
+            self.processes = ProcessManager()
+        return self.processes
+
+    def getWatcher(self):
+        if self.watcher is None:
+            self.watcher = FileWatcher()
+        return self.watcher
+
+    def getSaver(self):
+        if self.saver is None:
+            self.saver = FileSaver()
+        return self.saver
     
     def noSymbolWarning(self):
         self.warning(f'Symbol "{self.getToken()}" not found')
@@ -126,14 +178,14 @@ class Core(Handler):
         self.putSymbolValue(target, targetValue)
         return self.nextPC()
 
-    # Append a value to a list or a queue
-    # append {value} to {list/queue}
+    # Append a value to a list, a queue or a string builder
+    # append {value} to {list/queue/builder}
     def k_append(self, command):
         command['value'] = self.nextValue()
         if self.nextIs('to'):
             if self.nextIsSymbol():
                 record = self.getSymbolRecord()
-                self.program.checkObjectType(self.getObject(record), (ECList, ECQueue))
+                self.program.checkObjectType(self.getObject(record), (ECList, ECQueue, ECBuilder))
                 command['target'] = record['name']
                 self.add(command)
                 return True
@@ -175,6 +227,14 @@ class Core(Handler):
         else:
             return self.compileFromHere(['end'])
 
+    # Declare a string builder variable
+    def k_builder(self, command):
+        self.compiler.addValueType()
+        return self.compileVariable(command, 'ECBuilder')
+
+    def r_builder(self, command):
+        return self.nextPC()
+
     # clear {variable}
     # clear entry {name} of {dictionary}
     # clear item {index} of {list}
@@ -206,7 +266,7 @@ class Core(Handler):
             record = self.getSymbolRecord()
             command['target'] = record['name']
             object = self.getObject(record)
-            if isinstance(object, ECSSH):
+            if isinstance(object, (ECSSH, ECBuilder)):
                 self.add(command)
                 return True
             if isinstance(object, ECVariable):
@@ -228,17 +288,21 @@ class Core(Handler):
         else:
             target = self.getVariable(command['target'])
             if target['keyword'] == 'ssh':
+                self.getObject(target).close()
                 target['ssh'] = None
+            elif isinstance(self.getObject(target), ECBuilder):
+                # Clearing a builder empties it
+                self.getObject(target).reset()
             else:
                 self.putSymbolValue(target, ECValue(type=bool, content=False))
         return self.nextPC()
 
-    # Close a file
-    # close {file}
+    # Close a file or a store
+    # close {file/store}
     def k_close(self, command):
         if self.nextIsSymbol():
             fileRecord = self.getSymbolRecord()
-            if isinstance(self.getObject(fileRecord), ECFile):
+            if isinstance(self.getObject(fileRecord), (ECFile, ECStore)):
                 command['file'] = fileRecord['name']
                 self.add(command)
                 return True
@@ -246,7 +310,13 @@ class Core(Handler):
 
     def r_close(self, command):
         fileRecord = self.getVariable(command['file'])
-        fileRecord['file'].close()
+        object = self.getObject(fileRecord)
+        if isinstance(object, ECStore):
+            object.close()
+        elif object.isMapped():
+            object.unmap()
+        else:
+            fileRecord['file'].close()
         return self.nextPC()
 
     # copy {variable} to {variable}
@@ -488,28 +558,100 @@ class Core(Handler):
         self.putSymbolValue(target, targetValue)
         return self.nextPC()
 
-    # download [binary] {url} to {path}
+    # download [binary] {url} to {path} [segments {n}] [buffer {n}] [resume] [checksum {hex}] [or {command}]
+    # download {ssh} {remote path} to {path} [or {command}]
     def k_download(self, command):
         if self.nextIs('binary'):
             command['binary'] = True
             self.nextToken()
         else: command['binary'] = False
+        if self.isSymbol() and self.getSymbolRecord()['keyword'] == 'ssh':
+            command['ssh'] = self.getToken()
+            command['remote'] = self.nextValue()
+            self.skip('to')
+            command['path'] = self.nextValue()
+            command['or'] = None
+            self.processOr(command, self.getCodeSize())
+            return True
         command['url'] = self.getValue()
         self.skip('to')
         command['path'] = self.nextValue()
-        self.add(command)
+        command['ranged'] = False
+        command['segments'] = ECValue(type=int, content=1)
+        command['buffer'] = ECValue(type=int, content=1048576)
+        command['resume'] = False
+        command['checksum'] = None
+        while True:
+            token = self.peek()
+            if token in ('segments', 'buffer', 'checksum'):
+                self.nextToken()
+                command[token] = self.nextValue()
+            elif token == 'resume':
+                self.nextToken()
+                command['resume'] = True
+            else: break
+            command['ranged'] = True
+        command['or'] = None
+        self.processOr(command, self.getCodeSize())
         return True
-    
+
     def r_download(self, command):
-        binary = command['binary']
+        global errorReason
+        if 'ssh' in command:
+            return self.transferSFTP(command, 'get')
         url = self.textify(command['url'])
         path = self.textify(command['path'])
-        mode = 'wb' if binary else 'w'
-        response = requests.get(url, stream=True)
         local_path = self.resolveLocalPath(path)
-        with open(local_path, mode) as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk: f.write(chunk)
+        try:
+            if command['ranged']:
+                # A ranged download copies the bytes exactly, so it works the same for text
+                checksum = command['checksum']
+                self.getHTTP().download(url, local_path,
+                    segments=self.textify(command['segments']),
+                    resume=command['resume'],
+                    bufferSize=int(self.textify(command['buffer'])),
+                    checksum=self.textify(checksum) if checksum is not None else None)
+            else:
+                self.downloadStream(url, local_path)
+        except Exception as e:
+            errorReason = str(e)
+            if command['or'] != None:
+                return command['or']
+            RuntimeError(self.program, f'Error: {errorReason}')
+        return self.nextPC()
+
+    # Save the bytes as they arrive. Text is not decoded, since the charset a
+    # server reports (or the one assumed when it reports none) may be wrong,
+    # and the file keeps whatever encoding it was served in. An error status
+    # fails the download, and the file is only replaced once it is complete.
+    def downloadStream(self, url, local_path):
+        with self.getHTTP().get(url, stream=True) as response:
+            response.raise_for_status()
+            with replacing(str(local_path)) as temp:
+                with open(temp, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=8192):
+                        if chunk: f.write(chunk)
+
+    # Copy a file between here and an SSH server without loading it into memory
+    def transferSFTP(self, command, direction):
+        global errorReason
+        remote = self.textify(command['remote'])
+        local_path = str(self.resolveLocalPath(self.textify(command['path'])))
+        try:
+            if direction == 'get':
+                # get() reads ahead and put() pipelines its writes. It creates
+                # the local file before reading the remote one, so it writes
+                # to a temporary file, leaving any file already there intact
+                # if the download fails.
+                with replacing(local_path) as temp:
+                    self.getObject(self.getVariable(command['ssh'])).call(lambda sftp: sftp.get(remote, temp))
+            else:
+                self.getObject(self.getVariable(command['ssh'])).call(lambda sftp: sftp.put(local_path, remote))
+        except Exception as e:
+            errorReason = str(e)
+            if command['or'] != None:
+                return command['or']
+            RuntimeError(self.program, f'Error: {errorReason}')
         return self.nextPC()
 
     # Match a begin
@@ -558,6 +700,7 @@ class Core(Handler):
         return next
 
     # get {variable) from url {url} [or {command}]
+    # get {dictionary} from urls {list/dictionary} [parallel {n}] [timeout {n}] [on each response {action}]
     def k_get(self, command):
         if self.nextIsSymbol():
             record = self.getSymbolRecord()
@@ -566,7 +709,11 @@ class Core(Handler):
             else:
                 NoValueError(self.compiler, record)
         if self.nextIs('from'):
-            if self.nextIs('url'):
+            token = self.nextToken()
+            if token == 'urls':
+                self.checkObjectType(self.getObject(record), ECDictionary)
+                return self.compileGetURLs(command)
+            if token == 'url':
                 url = self.nextValue()
                 if url != None:
                     command['url'] = url
@@ -582,15 +729,120 @@ class Core(Handler):
                     return True
         return False
 
+    # Compile an event handler: a jump over it, then an optional internal
+    # command that takes the next event from its queue, then the action and
+    # a 'stop'. Returns the address of the handler.
+    def compileHandler(self, command, first=None):
+        cmd = {}
+        cmd['domain'] = 'core'
+        cmd['lino'] = command['lino']
+        cmd['keyword'] = 'gotoPC'
+        cmd['goto'] = 0
+        cmd['debug'] = False
+        skip = self.getCodeSize()
+        self.add(cmd)
+        handler = self.getCodeSize()
+        if first is not None:
+            cmd = {}
+            cmd['domain'] = 'core'
+            cmd['lino'] = command['lino']
+            cmd['keyword'] = first
+            cmd['debug'] = False
+            self.add(cmd)
+        self.compileOne()
+        cmd = {}
+        cmd['domain'] = 'core'
+        cmd['lino'] = command['lino']
+        cmd['keyword'] = 'stop'
+        cmd['debug'] = False
+        self.add(cmd)
+        self.getCommandAt(skip)['goto'] = self.getCodeSize()
+        return handler
+
+    # Compile the concurrent form of 'get'
+    def compileGetURLs(self, command):
+        command['urls'] = self.nextValue()
+        command['parallel'] = ECValue(type=int, content=8)
+        command['timeout'] = ECValue(type=int, content=5)
+        while self.peek() in ('parallel', 'timeout'):
+            command[self.nextToken()] = self.nextValue()
+        command['onResponse'] = None
+        self.add(command)
+        # The dictionary is filled by an internal command that runs when all
+        # the responses are in
+        result = {}
+        result['domain'] = 'core'
+        result['lino'] = command['lino']
+        result['keyword'] = 'urlsResult'
+        result['target'] = command['target']
+        result['debug'] = False
+        self.add(result)
+        if self.peek() == 'on':
+            self.nextToken()
+            self.skip('each')
+            if not self.nextIs('response'):
+                return False
+            self.nextToken()
+            # The handler starts by taking the next response from the queue
+            command['onResponse'] = self.compileHandler(command, 'nextResponse')
+        return True
+
+    # Run the concurrent form of 'get'. The requests are made on a worker
+    # thread, so other parts of the script carry on meanwhile, and this
+    # thread resumes at the result command when they have all finished.
+    def getURLs(self, command):
+        urls = self.textify(command['urls'])
+        if isinstance(urls, str): urls = json.loads(urls)
+        if isinstance(urls, list): urls = {url: url for url in urls}
+        if not isinstance(urls, dict):
+            RuntimeError(self.program, 'A list or dictionary of URLs is required')
+        parallel = self.textify(command['parallel'])
+        timeout = self.textify(command['timeout'])
+        onResponse = command['onResponse']
+        callback = None
+        if onResponse is not None:
+            responses = self.responses.setdefault(onResponse, deque())
+            def callback(name, status, text):
+                responses.append((name, status, text))
+                self.program.queueIntent(onResponse)
+        resume = self.nextPC()
+        queue = self.urlResults.setdefault(resume, deque())
+        def fetch():
+            try:
+                queue.append(self.getHTTP().fetchAll(urls, parallel, timeout, callback))
+            except Exception as e:
+                queue.append(e)
+            self.program.queueIntent(resume)
+        threading.Thread(target=fetch, daemon=True).start()
+        return None
+
+    # Put the responses of a concurrent 'get' into its dictionary
+    def r_urlsResult(self, command):
+        results = self.urlResults[self.program.pc].popleft()
+        if isinstance(results, Exception):
+            RuntimeError(self.program, f'Error: {results}')
+        dictionary = self.getObject(self.getVariable(command['target']))
+        for name, (status, text) in results.items():
+            dictionary.setEntry(name, text if 0 < status < 400 else None)
+        return self.nextPC()
+
+    # Make the next queued response of a concurrent 'get' the current one
+    def r_nextResponse(self, command):
+        responses = self.responses.get(self.program.pc)
+        self.response = responses.popleft() if responses else None
+        return self.nextPC()
+
     def r_get(self, command):
         global errorCode, errorReason
+        if 'urls' in command:
+            return self.getURLs(command)
         retval = ECValue(type=str)
         url = self.textify(command['url'])
         target = self.getVariable(command['target'])
         response = {}
         try:
             timeout = self.textify(command['timeout'])
-            response = requests.get(url, auth = ('user', 'pass'), timeout=timeout)
+            response = self.getHTTP().fetch(url, auth = ('user', 'pass'), timeout=timeout)
             if response.status_code >= 400:
                 errorCode = response.status_code
                 errorReason = response.reason
@@ -799,6 +1051,7 @@ class Core(Handler):
 
     # 1 Load a plugin. This is done at compile time.
     # 2 Load text from a file or ssh
+    # 3 Map a file into a file variable
     def k_load(self, command):
         self.nextToken()
         if self.tokenIs('plugin'):
@@ -809,7 +1062,7 @@ class Core(Handler):
                 return True
         elif self.isSymbol():
             record = self.getSymbolRecord()
-            if isinstance(self.getObject(record), (ECVariable, ECDictionary, ECList)):
+            if isinstance(self.getObject(record), (ECVariable, ECDictionary, ECList, ECFile)):
                 command['target'] = record['name']
                 if self.nextIs('from'):
                     if self.nextIsSymbol():
@@ -835,10 +1088,8 @@ class Core(Handler):
         if 'ssh' in command:
             ssh = self.getVariable(command['ssh'])
             path = self.textify(command['path'])
-            sftp = ssh['sftp']
-            # print(f'Loading from path: {Path(path).expanduser()}')
             try:
-                with sftp.open(path, 'r') as remote_file: content = remote_file.read().decode()
+                content = self.getObject(ssh).call(lambda sftp: sftpReadText(sftp, path))
             except:
                 errorReason = f'Unable to read from {path}'
                 if command['or'] != None:
@@ -850,7 +1101,11 @@ class Core(Handler):
             filename = self.textify(command['file'])
             try:
                 path = self.resolveLocalPath(filename)
-                print(path)
+                object = self.getObject(target)
+                if isinstance(object, ECFile):
+                    # Map the file instead of reading it
+                    object.map(path)
+                    return self.nextPC()
                 with open(path) as f: content = f.read()
             except:
                 errorReason = f'Unable to read from {filename}'
@@ -974,44 +1229,66 @@ class Core(Handler):
         return self.nextPC()
 
     # on message {action}
+    # on file/directory change {path} {action}
     def k_on(self, command):
         token = self.nextToken()
+        if token in ('file', 'directory'):
+            if not self.nextIs('change'):
+                return False
+            command['watch'] = token
+            command['path'] = self.nextValue()
+            self.nextToken()
+            command['goto'] = 0
+            self.add(command)
+            # The handler starts by taking the next change from the queue
+            self.compileHandler(command, 'nextChange')
+            command['goto'] = self.getCodeSize()
+            return True
         if token == 'message':
             self.nextToken()
             command['goto'] = 0
             self.add(command)
-            cmd = {}
-            cmd['domain'] = 'core'
-            cmd['lino'] = command['lino']
-            cmd['keyword'] = 'gotoPC'
-            cmd['goto'] = 0
-            cmd['debug'] = False
-            self.add(cmd)
-            # Add the action and a 'stop'
-            self.compileOne()
-            cmd = {}
-            cmd['domain'] = 'core'
-            cmd['lino'] = command['lino']
-            cmd['keyword'] = 'stop'
-            cmd['debug'] = False
-            self.add(cmd)
-            # Fixup the link
+            self.compileHandler(command)
             command['goto'] = self.getCodeSize()
             return True
         return False
 
     def r_on(self, command):
+        if 'watch' in command:
+            path = str(self.resolveLocalPath(self.textify(command['path'])))
+            handler = self.nextPC()+1
+            changes = self.changes.setdefault(handler, deque())
+            def onChange(changed):
+                changes.append(changed)
+                self.program.queueIntent(handler)
+            try:
+                self.getWatcher().watch(path, command['watch'] == 'directory', onChange)
+            except OSError as e:
+                RuntimeError(self.program, f'Unable to watch {path}: {e}')
+            return command['goto']
         self.program.onMessage(self.nextPC()+1)
         return command['goto']
 
-    # Open a file
-    # open {file} for reading/writing/appending
+    # Make the next queued file change the current one
+    def r_nextChange(self, command):
+        changes = self.changes.get(self.program.pc)
+        self.changedFile = changes.popleft() if changes else ''
+        return self.nextPC()
+
+    # Open a file or a store
+    # open {file} {path} for reading/writing/appending
+    # open {store} {path} [cache {size}] [batch {size}]
     def k_open(self, command):
         if self.nextIsSymbol():
             record = self.getSymbolRecord()
             command['target'] = record['name']
             command['path'] = self.nextValue()
-            if record['keyword'] == 'file':
+            if isinstance(self.getObject(record), ECStore):
+                while self.peek() in ('cache', 'batch'):
+                    command[self.nextToken()] = self.nextValue()
+                self.add(command)
+                return True
+            elif record['keyword'] == 'file':
                 if self.peek() == 'for':
                     self.nextToken()
                     token = self.nextToken()
@@ -1039,6 +1316,15 @@ class Core(Handler):
         record = self.getVariable(command['target'])
         path = self.textify(command['path'])
         file_path = self.resolveLocalPath(path)
+        object = self.getObject(record)
+        if isinstance(object, ECStore):
+            cacheSize = self.textify(command['cache']) if 'cache' in command else None
+            batchSize = self.textify(command['batch']) if 'batch' in command else None
+            try:
+                object.open(str(file_path), cacheSize, batchSize)
+            except Exception as e:
+                RuntimeError(self.program, f'Unable to open store {path}: {e}')
+            return self.nextPC()
         if command['mode'] == 'r' and os.path.exists(file_path) or command['mode'] != 'r':
             record['file'] = open(file_path, command['mode'])
             return self.nextPC()
@@ -1102,7 +1388,7 @@ class Core(Handler):
         value = self.textify(command['value'])
         url = self.textify(command['url'])
         try:
-            response = requests.post(url, value, timeout=5)
+            response = self.getHTTP().post(url, value, timeout=5)
             retval.setContent(response.text) # type: ignore
             if response.status_code >= 400:
                 errorCode = response.status_code
@@ -1179,8 +1465,8 @@ class Core(Handler):
                     record = self.getSymbolRecord()
                     command['target'] = record['name']
                     object = self.getObject(record)
-                    self.checkObjectType(object, (ECVariable, ECDictionary, ECList))
-                    if (isinstance(object, ECVariable) and not valueType in ('dict', 'list', 'json') or
+                    self.checkObjectType(object, (ECVariable, ECDictionary, ECList, ECBuilder))
+                    if (isinstance(object, (ECVariable, ECBuilder)) and not valueType in ('dict', 'list', 'json') or
                         isinstance(object, (ECDictionary, ECList))):
                         command['or'] = None
                         self.processOr(command, self.getCodeSize())
@@ -1231,9 +1517,17 @@ class Core(Handler):
         record = self.getVariable(command['target'])
         fileRecord = self.getVariable(command['file'])
         line = command['line']
+        object = self.getObject(fileRecord)
+        if object.isMapped():
+            if line:
+                content = object.readLine()
+                if content is None: content = ''
+            else: content = object.getText(object.position)
+            self.putSymbolValue(record, ECValue(type=str, content=content))
+            return self.nextPC()
         file = fileRecord['file']
         if file.mode == 'r':
-            content = file.readline().split('\n')[0] if line else file.read()
+            content = file.readline().rstrip('\n') if line else file.read()
             value = ECValue(type=str, content=content)
             self.putSymbolValue(record, value)
         return self.nextPC()
@@ -1373,15 +1667,15 @@ class Core(Handler):
         return True
 
     def r_save(self, command):
+        global errorReason
         errorReason = None
-        content = self.textify(command['content'])
         if 'ssh' in command:
+            content = self.textify(command['content'])
             ssh = self.getVariable(command['ssh'])
             path = self.textify(command['path'])
-            sftp = ssh['sftp']
             if path.endswith('.json'): content = json.dumps(content)
             try:
-                with sftp.open(path, 'w') as remote_file: remote_file.write(content)
+                self.getObject(ssh).call(lambda sftp: sftpWriteText(sftp, path, content))
             except:
                 errorReason = 'Unable to write to {path}'
                 if command['or'] != None:
@@ -1392,16 +1686,22 @@ class Core(Handler):
         else:
             filename = self.textify(command['file'])
             try:
-                if content == None:
-                    content = ''
-                elif isinstance(content, dict) or isinstance(content, list):
-                    content = json.dumps(content)
-                elif not isinstance(content, str):
-                    content = self.textify(content)
                 path = self.resolveLocalPath(filename)
-                with open(path, 'w') as f: f.write(content)
+                # Hand over a dictionary or list as it is, so it is encoded
+                # with the chosen encoder
+                source = command['content']
+                object = None
+                if source.getType() == 'symbol':
+                    object = self.getObject(self.getVariable(source.name))
+                if isinstance(object, (ECDictionary, ECList)) and not isinstance(object, ECStore):
+                    content = object.getValue()
+                else: content = self.textify(source)
+                self.getSaver().save(path, content)
             except Exception as e:
                 errorReason = f'Unable to write to {filename}: {str(e)}'
+            # An earlier save deferred by the save window may have failed since
+            if errorReason is None:
+                errorReason = self.getSaver().takeError()
 
         if errorReason:
             if command['or'] != None:
@@ -1504,9 +1804,11 @@ class Core(Handler):
     # set {variable} [to {value}]
     # set entry {key} of {dictionary} [to {value}]
     # set item {index} of {list} [to {value}]
-    # set {ssh} host {host} user {user} password {password}
+    # set {ssh} host {host} [port {port}] user {user} password {password}
     # set the items/elements in/of {variable} to {value}
     # set item/entry/property of {variable} to {value}
+    # set [the] http pool/retries/backoff/keepalive to {value}
+    # set [the] save atomic/sync/window/encoder to {value}
     # set breakpoint
     def k_set(self, command):
         if self.nextIsSymbol():
@@ -1514,6 +1816,7 @@ class Core(Handler):
             command['target'] = record['name']
             if self.isObjectType(record, ECSSH):
                 host = None
+                port = ECValue(type=int, content=22)
                 user = None
                 password = None
                 while True:
@@ -1521,6 +1824,9 @@ class Core(Handler):
                     if token == 'host':
                         self.nextToken()
                         host = self.nextValue()
+                    elif token == 'port':
+                        self.nextToken()
+                        port = self.nextValue()
                     elif token == 'user':
                         self.nextToken()
                         user = self.nextValue()
@@ -1529,6 +1835,7 @@ class Core(Handler):
                         password = self.nextValue()
                     else: break
                 command['host'] = host
+                command['port'] = port
                 command['user'] = user
                 command['password'] = password
                 command['type'] = 'ssh'
@@ -1571,6 +1878,34 @@ class Core(Handler):
                 self.add(command)
                 return True
 
+        elif token == 'http':
+            option = self.nextToken()
+            if option == 'cache':
+                # set http cache [size/ttl/path] to {value}
+                if self.peek() in ('size', 'ttl', 'path'):
+                    option = f'cache {self.nextToken()}'
+                if self.nextIs('to'):
+                    command['option'] = option
+                    command['value'] = self.nextValue()
+                    self.add(command)
+                    return True
+            elif option in ('pool', 'retries', 'backoff', 'keepalive'):
+                command['option'] = option
+                self.skip('size')
+                if self.nextIs('to'):
+                    command['value'] = self.nextValue()
+                    self.add(command)
+                    return True
+
+        elif token == 'save':
+            option = self.nextToken()
+            if option in ('atomic', 'sync', 'window', 'encoder'):
+                command['option'] = option
+                if self.nextIs('to'):
+                    command['value'] = self.nextValue()
+                    self.add(command)
+                    return True
+
         elif token in ('entry', 'property'):
             command['key'] = self.nextValue()
             if command['key'] == None:
@@ -1660,6 +1995,43 @@ class Core(Handler):
             self.encoding = self.textify(command['encoding'])
             return self.nextPC()
 
+        elif cmdType == 'http':
+            value = self.textify(command['value'])
+            option = command['option']
+            if option == 'pool':
+                self.getHTTP().configure(poolSize=value)
+            elif option == 'retries':
+                self.getHTTP().configure(retries=value)
+            elif option == 'backoff':
+                # The backoff is given in milliseconds
+                self.getHTTP().configure(backoff=int(value) / 1000)
+            elif option == 'keepalive':
+                self.getHTTP().configure(keepAlive=value not in (False, 'false', 0))
+            elif option in ('cache', 'cache size'):
+                self.getHTTP().configureCache(size=value)
+            elif option == 'cache ttl':
+                self.getHTTP().configureCache(ttl=value)
+            elif option == 'cache path':
+                self.getHTTP().configureCache(path=value)
+            return self.nextPC()
+
+        elif cmdType == 'save':
+            value = self.textify(command['value'])
+            option = command['option']
+            if option == 'atomic':
+                self.getSaver().configure(atomic=value not in (False, 'false', 0))
+            elif option == 'sync':
+                self.getSaver().configure(sync=value not in (False, 'false', 0))
+            elif option == 'window':
+                # The window is given in milliseconds
+                self.getSaver().configure(window=int(value) / 1000)
+            elif option == 'encoder':
+                try:
+                    self.getSaver().configure(encoder=getEncoder(value))
+                except Exception as e:
+                    RuntimeError(self.program, f'Unable to use encoder {value}: {e}')
+            return self.nextPC()
+
         elif cmdType == 'path':
             path = self.textify(command['path'])
             os.chdir(path)
@@ -1667,13 +2039,19 @@ class Core(Handler):
 
         elif cmdType == 'property':
             key = self.textify(command['key'])
-            value = self.evaluate(command['value'])
             record = self.getVariable(command['target'])
             variable = self.getObject(record)
+            value = self.evaluate(command['value'])
+            if isinstance(variable, ECDictionary):
+                # Properties of a dictionary are its entries; assign in place,
+                # keeping the value as it was evaluated, so strings such as
+                # `123` stay strings
+                variable.getValue()[key] = value if isinstance(value, dict) else self.textify(value)
+                return self.nextPC()
             variable.setProperty(key, value)
             content = variable.getContent()
             if content == None: content = {}
-            elif not isinstance(content, dict): 
+            elif not isinstance(content, dict):
                 raise RuntimeError(self.program, f'{record["name"]} is not a dictionary')
             if isinstance(value, dict): content[key] = value
             else: content[key] = self.textify(value)
@@ -1685,13 +2063,13 @@ class Core(Handler):
             host = self.textify(command['host'])
             user = self.textify(command['user'])
             password = self.textify(command['password'])
-            ssh = paramiko.SSHClient()
-            target['ssh'] = ssh
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            try:
-                ssh.connect(host, username=user, password=password, timeout=10)
-                target['sftp'] = ssh.open_sftp()
-            except:
+            port = self.textify(command['port']) if 'port' in command else 22
+            ssh = self.getObject(target)
+            target.pop('error', None)
+            if ssh.setup(host, user, password, port):
+                target['ssh'] = ssh.key
+            else:
+                target['ssh'] = None
                 target['error'] = f'Unable to connect to {host} (timeout)'
             return self.nextPC()
         
@@ -1699,22 +2077,23 @@ class Core(Handler):
             self.program.breakpoint = True
             return self.nextPC()
 
-    # Shuffle a JSON list
+    # Shuffle a list, or a variable holding a JSON list
     def k_shuffle(self, command):
         if self.nextIsSymbol():
             record = self.getSymbolRecord()
-            if record['hasValue']:
+            if isinstance(self.getObject(record), (ECVariable, ECList)):
                 command['target'] = self.getToken()
                 self.add(command)
                 return True
-            self.warning(f'Core.negate: Variable {record["name"]} does not hold a value')
+            self.warning(f'Core.shuffle: Variable {record["name"]} does not hold a value')
         return False
 
     def r_shuffle(self, command):
         record = self.getVariable(command['target'])
-        if not record['hasValue']:
-            NoValueRuntimeError(self.program, record)
-            return None
+        variable = self.getObject(record)
+        if isinstance(variable, ECList):
+            variable.shuffle()
+            return self.nextPC()
         value = self.getSymbolValue(record)
         if value == None:
             RuntimeError(self.program, f'{record["name"]} has not been initialised')
@@ -1750,17 +2129,8 @@ class Core(Handler):
     def r_split(self, command):
         target = self.getVariable(command['target'])
         value = self.getSymbolValue(target)
-        content = value.getContent().split(self.textify(command['on']))
-        elements = len(content)
-        object = target['object']
-        object.setElements(elements)
-        
-        for n in range(0, elements):
-            val = ECValue(type=str, content=content[n])
-            object.setIndex(n)
-            object.setValue(val)
-        object.setIndex(0)
-
+        # The elements are a view over the original string, materialised when indexed
+        target['object'].setSplit(value.getContent(), self.textify(command['on']))
         return self.nextPC()
 
     # Declare an SSH connection variable
@@ -1787,8 +2157,19 @@ class Core(Handler):
     def r_stop(self, command):
         return 0
 
+    # Declare a store (a dictionary held in a local database)
+    def k_store(self, command):
+        self.compiler.addValueType()
+        return self.compileVariable(command, 'ECStore')
+
+    def r_store(self, command):
+        return self.nextPC()
+
     # Issue a system call
     # system {command}
+    # system background {command}
+    # system {command} [giving {variable}] [errors {variable}] [status {variable}]
+    #     [timeout {seconds}] [on each line {action}]
     def k_system(self, command):
         background = False
         token = self.nextToken()
@@ -1796,22 +2177,90 @@ class Core(Handler):
             self.nextToken()
             background = True
         value = self.getValue()
-        if value != None:
-            command['value'] = value
-            command['background'] = background
+        if value == None:
+            FatalError(self.compiler, 'I can\'t give this command')
+            return False
+        command['value'] = value
+        command['background'] = background
+        if background:
             self.add(command)
             return True
-        FatalError(self.compiler, 'I can\'t give this command')
-        return False
+        # The results are put into variables by an internal command that
+        # runs when the system command has finished
+        result = {}
+        result['domain'] = 'core'
+        result['lino'] = command['lino']
+        result['keyword'] = 'systemResult'
+        result['debug'] = False
+        command['timeout'] = None
+        while self.peek() in ('giving', 'errors', 'status', 'timeout'):
+            token = self.nextToken()
+            if token == 'timeout':
+                command['timeout'] = self.nextValue()
+            elif self.nextIsSymbol():
+                record = self.getSymbolRecord()
+                self.checkObjectType(self.getObject(record), ECVariable)
+                result[token] = record['name']
+            else: return False
+        command['capture'] = 'giving' in result
+        command['captureErrors'] = 'errors' in result
+        command['onLine'] = None
+        self.add(command)
+        self.add(result)
+        if self.peek() == 'on':
+            self.nextToken()
+            self.skip('each')
+            if not self.nextIs('line'):
+                return False
+            self.nextToken()
+            # The handler starts by taking the next line from the queue
+            command['onLine'] = self.compileHandler(command, 'nextLine')
+        return True
 
     def r_system(self, command):
         value = self.textify(command['value'])
-        if value != None:
-            if command['background']:
-                subprocess.Popen(["sh",value,"&"])
-            else:
-                os.system(value)
+        if value == None:
+            return self.nextPC()
+        if command['background']:
+            self.getProcesses().background(value)
             return self.nextPC()
+        # Run the command on a worker thread and carry on with this thread
+        # from the result command when it has finished
+        resume = self.nextPC()
+        results = self.systemResults.setdefault(resume, deque())
+        def onDone(output, errors, status, timedOut):
+            results.append((output, errors, status, timedOut))
+            self.program.queueIntent(resume)
+        onLine = None
+        if command['onLine'] is not None:
+            handler = command['onLine']
+            lines = self.outputLines.setdefault(handler, deque())
+            def onLine(line):
+                lines.append(line)
+                self.program.queueIntent(handler)
+        timeout = self.textify(command['timeout']) if command['timeout'] is not None else None
+        self.getProcesses().run(value, onDone, command['capture'], timeout, onLine, command['captureErrors'])
+        return None
+
+    # Put the results of a system command into variables
+    def r_systemResult(self, command):
+        global errorCode, errorReason
+        output, errors, status, timedOut = self.systemResults[self.program.pc].popleft()
+        errorCode = status
+        errorReason = 'Timed out' if timedOut else errors
+        if 'giving' in command:
+            self.putSymbolValue(self.getVariable(command['giving']), ECValue(type=str, content=output))
+        if 'errors' in command:
+            self.putSymbolValue(self.getVariable(command['errors']), ECValue(type=str, content=errors))
+        if 'status' in command:
+            self.putSymbolValue(self.getVariable(command['status']), ECValue(type=int, content=status))
+        return self.nextPC()
+
+    # Make the next queued line of system output the current one
+    def r_nextLine(self, command):
+        lines = self.outputLines.get(self.program.pc)
+        self.line = lines.popleft() if lines else ''
+        return self.nextPC()
 
     # Arithmetic subtraction
     # take {value} from {variable}
@@ -1935,6 +2384,24 @@ class Core(Handler):
         target['locked'] = False
         return self.nextPC()
 
+    # Upload a file to an SSH server
+    # upload {path} to {ssh} {remote path} [or {command}]
+    def k_upload(self, command):
+        command['path'] = self.nextValue()
+        if self.nextIs('to'):
+            if self.nextIsSymbol():
+                record = self.getSymbolRecord()
+                if record['keyword'] == 'ssh':
+                    command['ssh'] = record['name']
+                    command['remote'] = self.nextValue()
+                    command['or'] = None
+                    self.processOr(command, self.getCodeSize())
+                    return True
+        return False
+
+    def r_upload(self, command):
+        return self.transferSFTP(command, 'put')
+
     # use plugin {class} from {source}
     # use graphics
     # use mqtt
@@ -2093,6 +2560,15 @@ class Core(Handler):
         self.putSymbolValue(record, value)
         return self.nextPC()
 
+    # Get the next value, allowing it to be a file variable
+    def nextValueOrFile(self):
+        self.nextToken()
+        if self.isSymbol() and isinstance(self.getObject(self.getSymbolRecord()), ECFile):
+            value = ECValue(type='symbol')
+            value.name = self.getToken() # type: ignore
+            return value
+        return self.getValue()
+
     #############################################################################
     # Compile a value in this domain
     def compileValue(self):
@@ -2100,7 +2576,7 @@ class Core(Handler):
         token = self.getToken()
         if self.isSymbol():
             record = self.getSymbolRecord()
-            if self.isObjectType(record, (ECVariable, ECDictionary, ECList, ECStack, ECSSH, ECFile, ECModule)):
+            if self.isObjectType(record, (ECVariable, ECDictionary, ECList, ECBuilder, ECStack, ECSSH, ECFile, ECModule)):
                 value.setType('symbol')
                 value.name = record['name']
                 return value
@@ -2198,6 +2674,17 @@ class Core(Handler):
 
         if token == 'count':
             if self.nextIs('of'):
+                if self.peek() == 'lines':
+                    # count of lines in {file}
+                    self.nextToken()
+                    self.skip('in')
+                    if self.nextIsSymbol():
+                        record = self.getSymbolRecord()
+                        self.checkObjectType(self.getObject(record), ECFile)
+                        value.setType('lineCount')
+                        value.setName(record['name'])
+                        return value
+                    return None
                 if self.nextIsSymbol():
                     record = self.getSymbolRecord()
                     object = record['object']
@@ -2241,7 +2728,7 @@ class Core(Handler):
         if token == 'length':
             value.setType('lengthOf')
             if self.nextIs('of'):
-                value.setContent(self.nextValue())
+                value.setContent(self.nextValueOrFile())
                 return value
             return None
 
@@ -2262,7 +2749,7 @@ class Core(Handler):
             else:
                 value.to = None # type: ignore
             if self.nextToken() == 'of':
-                value.setContent(self.nextValue())
+                value.setContent(self.nextValueOrFile())
                 return value
 
         # position of [the] [last] {needle} in {haystack}
@@ -2274,7 +2761,7 @@ class Core(Handler):
                 self.nextToken()
             value.needle = self.nextValue() # type: ignore
             self.skip('in')
-            value.haystack = self.nextValue() # type: ignore
+            value.haystack = self.nextValueOrFile() # type: ignore
             return value
 
         if token == 'timestamp':
@@ -2314,6 +2801,20 @@ class Core(Handler):
                         return value
             return None
 
+        if token == 'line':
+            return value
+
+        if token == 'changed':
+            if self.nextIs('file'):
+                return value
+            return None
+
+        if token == 'response':
+            value.item = 'text' # type: ignore
+            if self.peek() in ['name', 'status']:
+                value.item = self.nextToken() # type: ignore
+            return value
+
         if token == 'type':
             if self.nextIs('of'):
                 value.value = self.nextValue() # type: ignore
@@ -2350,7 +2851,7 @@ class Core(Handler):
     #############################################################################
 	# Get the value of an unknown item 
     def getUnknownValue(self, value):
-        if self.isObjectType(value, (ECVariable, ECDictionary, ECList)):
+        if self.isObjectType(value, (ECVariable, ECDictionary, ECList, ECBuilder)):
             return value.getContent()  # type: ignore
         return None # Unable to get value
 
@@ -2451,6 +2952,15 @@ class Core(Handler):
             value.setValue(type=str, content=record['error'] if 'error' in record else '')
         return value
 
+    def v_response(self, v):
+        response = self.response
+        if v.item == 'name':
+            return ECValue(type=str, content=response[0] if response else '')
+        if v.item == 'status':
+            return ECValue(type=int, content=response[1] if response else 0)
+        text = response[2] if response else None
+        return ECValue(type=str, content=text if text is not None else '')
+
     def v_files(self, v):
         path = self.textify(v.target)
         return ECValue(type=str, content=json.dumps(os.listdir(path)))
@@ -2466,13 +2976,16 @@ class Core(Handler):
         return value
 
     def v_from(self, v):
-        content = self.textify(v.getContent())
         start = self.textify(v.start)
         to = self.textify(v.to)
         if start is not None and type(start) != int:
             RuntimeError(self.program, 'Invalid "from" value')
         if to is not None and type(to) != int:
             RuntimeError(self.program, 'Invalid "to" value')
+        file = self.getMappedFile(v.getContent())
+        if file is not None:
+            return ECValue(type=str, content=file.getText(start, to))
+        content = self.textify(v.getContent())
         return ECValue(type=str, content=content[start:] if to == None else content[start:to])
 
     def v_hash(self, v):
@@ -2489,6 +3002,7 @@ class Core(Handler):
         if value == None:
             var = self.getObject(self.getVariable(v.variable))
             value = var.getContent()
+            if isinstance(value, ECValue): value = value.getContent()
         else:
             value = self.textify(value)
         target = self.getObject(self.getVariable(v.target))
@@ -2550,11 +3064,26 @@ class Core(Handler):
         return ECValue(type=str, content=content[0:count])
 
     def v_lengthOf(self, v):
+        file = self.getMappedFile(v.getContent())
+        if file is not None:
+            return ECValue(type=int, content=file.getSize())
         content = self.textify(v.getContent())
         if type(content) == str:
             return ECValue(type=int, content=len(content))
         RuntimeError(self.program, 'Value is not a string')
 
+    def v_changed(self, v):
+        return ECValue(type=str, content=self.changedFile)
+
+    def v_line(self, v):
+        return ECValue(type=str, content=self.line)
+
+    def v_lineCount(self, v):
+        file = self.getObject(self.getVariable(v.getName()))
+        if not file.isMapped():
+            RuntimeError(self.program, f'File {v.getName()} has not been loaded')
+        return ECValue(type=int, content=file.countLines())
+
     def v_lowercase(self, v):
         content = self.textify(v.getContent())
         return ECValue(type=str, content=content.lower())
@@ -2580,8 +3109,11 @@ class Core(Handler):
 
     def v_position(self, v):
         needle = self.textify(v.needle)
-        haystack = self.textify(v.haystack)
         last = v.last
+        file = self.getMappedFile(v.haystack)
+        if file is not None:
+            return ECValue(type=int, content=file.find(needle, last))
+        haystack = self.textify(v.haystack)
         return ECValue(type=int, content=haystack.rfind(needle) if last else haystack.find(needle))
 
     def v_prettify(self, v):
@@ -2626,7 +3158,7 @@ class Core(Handler):
     # This is used by the expression evaluator to get the value of a symbol
     def v_symbol(self, v):
         record = self.program.getSymbolRecord(v.name)
-        if self.isObjectType(record, (ECVariable, ECDictionary, ECList)):
+        if self.isObjectType(record, (ECVariable, ECDictionary, ECList, ECBuilder)):
             return self.getSymbolValue(record)
         elif self.isObjectType(record, ECSSH):
             return ECValue(type=bool, content=True if 'ssh' in record and record['ssh'] != None else False)
@@ -2812,6 +3344,7 @@ class Core(Handler):
                 return condition
 
         if token == 'includes':
+            self.nextToken()
             condition.value2 = self.nextValue() # type: ignore
             return condition
 
@@ -2875,7 +3408,7 @@ class Core(Handler):
         if condition.value1.getType() == 'symbol':
             record = self.getVariable(condition.value1.name)
             variable = self.getObject(record)
-            if isinstance(variable, (ECVariable, ECDictionary, ECList, ECQueue)):
+            if isinstance(variable, (ECVariable, ECDictionary, ECList, ECQueue, ECBuilder)):
                 comparison = variable.isEmpty()
                 return not comparison if condition.negate else comparison
         value = self.textify(condition.value1)
@@ -2923,8 +3456,14 @@ class Core(Handler):
         return not hasProp if condition.negate else hasProp
 
     def c_includes(self, condition):
-        value1 = self.textify(condition.value1)
         value2 = self.textify(condition.value2)
+        if condition.value1.getType() == 'symbol':
+            variable = self.getObject(self.getVariable(condition.value1.name))
+            if isinstance(variable, ECList):
+                # Lists use their hash index rather than scanning the JSON text
+                includes = variable.includes(value2)
+                return not includes if condition.negate else includes
+        value1 = self.textify(condition.value1)
         includes = value2 in value1
         return not includes if condition.negate else includes
 
@@ -2971,9 +3510,8 @@ class Core(Handler):
     def c_sshExists(self, condition):
         path = self.textify(condition.path)
         ssh = self.getVariable(condition.target)
-        sftp = ssh['sftp']
         try:
-            with sftp.open(path, 'r') as remote_file: remote_file.read().decode()
+            self.getObject(ssh).call(lambda sftp: sftp.stat(path))
             comparison = True
         except:
             comparison = False
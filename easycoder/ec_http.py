@@ -0,0 +1,364 @@
+import threading, requests, hashlib, json, os, time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+__all__ = ['HTTPCache', 'HTTPPool']
+
+# The hash algorithms that a checksum may use, by the length of its hex digest
+DIGESTS = {32: 'md5', 40: 'sha1', 64: 'sha256', 128: 'sha512'}
+
+# Downloads ask for the bytes as they are stored, since a server that
+# compresses a response would send ranges of the compressed form
+IDENTITY = {'Accept-Encoding': 'identity'}
+
+# How often the progress of a ranged download is recorded: after this many
+# bytes or this many seconds, whichever comes first
+SAVE_BYTES = 8 * 1048576
+SAVE_INTERVAL = 2
+
+# Compute the digest of a file, choosing the algorithm to match a checksum
+def fileDigest(path, checksum, bufferSize=1048576):
+    algorithm = DIGESTS.get(len(checksum))
+    if algorithm is None:
+        raise ValueError(f'Unrecognised checksum: {checksum}')
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(bufferSize)
+            if not chunk: break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+###############################################################################
+# A response served from the cache. It has the parts of a requests.Response
+# that the HTTP commands use
+class CachedResponse():
+    def __init__(self, text):
+        self.status_code = 200
+        self.reason = 'OK'
+        self.text = text
+        self.fromCache = True
+
+###############################################################################
+# A conditional response cache. Responses carrying an ETag or Last-Modified
+# header are kept, and later requests for the same URL are sent with
+# If-None-Match/If-Modified-Since so an unchanged resource costs a 304 with no
+# body. Within 'ttl' seconds of being stored an entry is served without any
+# request at all. The cache holds at most 'maxEntries' entries, evicting the
+# least recently used, and if a path is given each entry is also kept on disk
+# so it survives a restart.
+class HTTPCache():
+    def __init__(self, maxEntries=100, ttl=0, path=None):
+        self.maxEntries = maxEntries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.path = None
+        self.setPath(path)
+
+    # Set or clear the disk directory, pruning it to the size limit
+    def setPath(self, path):
+        self.path = path
+        if path is None: return
+        os.makedirs(path, exist_ok=True)
+        files = [os.path.join(path, name) for name in os.listdir(path) if name.endswith('.json')]
+        files.sort(key=os.path.getmtime, reverse=True)
+        for file in files[self.maxEntries:]:
+            os.remove(file)
+
+    def setSize(self, maxEntries):
+        self.maxEntries = max(1, int(maxEntries))
+        with self.lock:
+            self.trim()
+
+    def getFile(self, url):
+        return os.path.join(self.path, hashlib.sha1(url.encode()).hexdigest() + '.json')
+
+    # Drop the least recently used entries beyond the size limit
+    def trim(self):
+        while len(self.entries) > self.maxEntries:
+            url, _ = self.entries.popitem(last=False)
+            if self.path is not None:
+                try: os.remove(self.getFile(url))
+                except OSError: pass
+
+    # Find the entry for a URL, in memory or on disk
+    def lookup(self, url):
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is not None:
+                self.entries.move_to_end(url)
+                return entry
+        if self.path is None: return None
+        try:
+            with open(self.getFile(url), 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get('url') != url: return None
+        with self.lock:
+            self.entries[url] = entry
+            self.trim()
+        return entry
+
+    def store(self, url, entry):
+        with self.lock:
+            self.entries[url] = entry
+            self.entries.move_to_end(url)
+            self.trim()
+        if self.path is not None:
+            with open(self.getFile(url), 'w') as f:
+                json.dump(entry, f)
+
+    # Mark an entry as freshly validated
+    def touch(self, url, entry):
+        entry['stored'] = time.time()
+        if self.path is not None:
+            try: os.utime(self.getFile(url))
+            except OSError: pass
+
+    # Perform a GET through the cache
+    def get(self, pool, url, **kwargs):
+        entry = self.lookup(url)
+        if entry is not None:
+            if time.time() - entry['stored'] < self.ttl:
+                return CachedResponse(entry['text'])
+            headers = dict(kwargs.pop('headers', None) or {})
+            if entry.get('etag'): headers['If-None-Match'] = entry['etag']
+            if entry.get('modified'): headers['If-Modified-Since'] = entry['modified']
+            kwargs['headers'] = headers
+        response = pool.get(url, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            self.touch(url, entry)
+            return CachedResponse(entry['text'])
+        if response.status_code == 200:
+            etag = response.headers.get('ETag')
+            modified = response.headers.get('Last-Modified')
+            if etag or modified or self.ttl > 0:
+                self.store(url, {
+                    'url': url,
+                    'etag': etag,
+                    'modified': modified,
+                    'stored': time.time(),
+                    'text': response.text
+                })
+        return response
+
+    def clear(self):
+        with self.lock:
+            urls = list(self.entries.keys())
+            self.entries.clear()
+        if self.path is not None:
+            for url in urls:
+                try: os.remove(self.getFile(url))
+                except OSError: pass
+
+###############################################################################
+# A pool of keep-alive HTTP sessions, one per host, shared by all the HTTP
+# commands of a program
+class HTTPPool():
+    def __init__(self, poolSize=10, retries=0, backoff=0.5, keepAlive=True):
+        self.poolSize = poolSize
+        self.retries = retries
+        self.backoff = backoff
+        self.keepAlive = keepAlive
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.cache = None
+
+    # Change one or more settings. Existing sessions are closed so the new
+    # settings apply to the next request
+    def configure(self, poolSize=None, retries=None, backoff=None, keepAlive=None):
+        if poolSize is not None: self.poolSize = int(poolSize)
+        if retries is not None: self.retries = int(retries)
+        if backoff is not None: self.backoff = float(backoff)
+        if keepAlive is not None: self.keepAlive = bool(keepAlive)
+        self.close()
+
+    # Create a session for a host
+    def createSession(self):
+        session = requests.Session()
+        retry = Retry(
+            total=self.retries,
+            backoff_factor=self.backoff,
+            status_forcelist=(502, 503, 504),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.poolSize, max_retries=retry)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if not self.keepAlive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    # Get the session for the host of a URL
+    def getSession(self, url):
+        parts = urlsplit(url)
+        key = f'{parts.scheme}://{parts.netloc}'
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None:
+                session = self.createSession()
+                self.sessions[key] = session
+        return session
+
+    # Perform a request
+    def request(self, method, url, **kwargs):
+        return self.getSession(url).request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    # Perform a GET that goes through the response cache, if there is one
+    def fetch(self, url, **kwargs):
+        if self.cache is None:
+            return self.get(url, **kwargs)
+        return self.cache.get(self, url, **kwargs)
+
+    # Set up the response cache. A size of zero removes it
+    def configureCache(self, size=None, ttl=None, path=None):
+        if size is not None and int(size) <= 0:
+            self.cache = None
+            return
+        if self.cache is None:
+            self.cache = HTTPCache()
+        if size is not None: self.cache.setSize(size)
+        if ttl is not None: self.cache.ttl = float(ttl)
+        if path is not None: self.cache.setPath(path)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    # Fetch a set of URLs concurrently, with at most 'parallel' requests in
+    # flight. 'urls' maps names to URLs. Each result is passed to the callback
+    # (on a worker thread) as soon as it arrives, and the complete set is
+    # returned as a dict of name: (status, text). A request that fails without
+    # a response has a status of 0 and no text.
+    def fetchAll(self, urls, parallel=8, timeout=5, callback=None):
+        def fetch(name, url):
+            try:
+                response = self.get(url, timeout=timeout)
+                result = (response.status_code, response.text)
+            except Exception:
+                result = (0, None)
+            if callback is not None:
+                callback(name, *result)
+            return name, result
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=max(1, int(parallel))) as executor:
+            futures = [executor.submit(fetch, name, url) for name, url in urls.items()]
+            for future in as_completed(futures):
+                name, result = future.result()
+                results[name] = result
+        return results
+
+    # Download a URL to a local file as bytes. If the server accepts ranges
+    # the file is fetched as 'segments' parallel ranges into a .part file, and
+    # the progress of each range is recorded alongside it so an interrupted
+    # download can be resumed. On completion the file is checked against the
+    # checksum, if one is given, and renamed into place.
+    def download(self, url, path, segments=1, resume=False, bufferSize=1048576, checksum=None, timeout=30):
+        if checksum and len(checksum) not in DIGESTS:
+            raise ValueError(f'Unrecognised checksum: {checksum}')
+        path = str(path)
+        partPath = path + '.part'
+        statePath = partPath + '.json'
+        head = self.request('HEAD', url, headers=IDENTITY, allow_redirects=True, timeout=timeout)
+        head.raise_for_status()
+        size = int(head.headers.get('Content-Length', -1))
+        etag = head.headers.get('ETag') or head.headers.get('Last-Modified')
+        ranged = size > 0 and head.headers.get('Accept-Ranges') == 'bytes'
+
+        if ranged:
+            state = None
+            if resume and os.path.exists(partPath):
+                try:
+                    with open(statePath, 'r') as f: state = json.load(f)
+                except (OSError, ValueError): state = None
+                if state is not None and (state['size'] != size or state['etag'] != etag):
+                    state = None
+            if state is None:
+                segments = max(1, min(int(segments), size // bufferSize + 1))
+                step = size // segments
+                ranges = []
+                for n in range(segments):
+                    end = size - 1 if n == segments - 1 else (n + 1) * step - 1
+                    ranges.append([n * step, end, 0])
+                state = {'url': url, 'size': size, 'etag': etag, 'ranges': ranges}
+                with open(partPath, 'wb') as f: f.truncate(size)
+            lock = threading.Lock()
+            unsaved = {'bytes': 0, 'time': time.time()}
+
+            # Write the state to a new file and rename it into place, so an
+            # interruption leaves either the old state or the new one. The
+            # data is synced first, so the state never records more than is
+            # on disk.
+            def saveState():
+                fd = os.open(partPath, os.O_RDWR)
+                try: os.fsync(fd)
+                finally: os.close(fd)
+                unsaved['bytes'] = 0
+                unsaved['time'] = time.time()
+                tempPath = statePath + '.tmp'
+                with open(tempPath, 'w') as f:
+                    json.dump(state, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tempPath, statePath)
+
+            def fetch(part):
+                start, end, done = part
+                if start + done > end: return
+                headers = dict(IDENTITY, Range=f'bytes={start + done}-{end}')
+                try:
+                    with self.get(url, headers=headers, stream=True, timeout=timeout) as response:
+                        if response.status_code != 206:
+                            raise IOError(f'Range request failed with status {response.status_code}')
+                        with open(partPath, 'r+b') as f:
+                            f.seek(start + done)
+                            for chunk in response.iter_content(chunk_size=bufferSize):
+                                f.write(chunk)
+                                f.flush()
+                                with lock:
+                                    part[2] += len(chunk)
+                                    unsaved['bytes'] += len(chunk)
+                                    if unsaved['bytes'] >= SAVE_BYTES or time.time() - unsaved['time'] >= SAVE_INTERVAL:
+                                        saveState()
+                finally:
+                    # Keep what this range got, even if it stopped early
+                    with lock:
+                        saveState()
+
+            saveState()
+            ranges = state['ranges']
+            with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                for future in [executor.submit(fetch, part) for part in ranges]:
+                    future.result()
+        else:
+            # No range support, so fetch the whole file in one stream
+            with self.get(url, headers=IDENTITY, stream=True, timeout=timeout) as response:
+                response.raise_for_status()
+                with open(partPath, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=bufferSize):
+                        f.write(chunk)
+
+        if checksum:
+            digest = fileDigest(partPath, checksum)
+            if digest != checksum.lower():
+                os.remove(partPath)
+                if os.path.exists(statePath): os.remove(statePath)
+                raise IOError(f'Checksum mismatch for {url}: got {digest}')
+        os.replace(partPath, path)
+        if os.path.exists(statePath): os.remove(statePath)
+
+    # Close all the sessions
+    def close(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+        for session in sessions:
+            session.close()
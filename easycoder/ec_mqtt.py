@@ -1,13 +1,84 @@
 from cmath import log
 from easycoder import Handler, ECObject, ECValue, RuntimeError
+from easycoder import ec_core
 import paho.mqtt.client as mqtt
+import socket
 import time
 import threading
 import json
+import random
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
  
+#############################################################################
+# A trie of topic filters, which may contain '+' (one level) and '#' (all
+# the remaining levels) wildcards, for finding the values added for every
+# filter that matches a topic without testing the filters one by one
+class TopicTrie():
+    def __init__(self):
+        self.root = {}
+
+    def add(self, filter, value):
+        node = self.root
+        for level in filter.split('/'):
+            node = node.setdefault(level, {})
+        node.setdefault(None, []).append(value)
+
+    def match(self, topic):
+        matches = []
+        levels = topic.split('/')
+        # Wildcards at the first level don't match topics that start with '$'
+        self.walk(self.root, levels, 0, matches, not topic.startswith('$'))
+        return matches
+
+    def walk(self, node, levels, n, matches, wild=True):
+        if wild and '#' in node:
+            matches.extend(node['#'].get(None, []))
+        if n == len(levels):
+            matches.extend(node.get(None, []))
+            return
+        child = node.get(levels[n])
+        if child is not None:
+            self.walk(child, levels, n + 1, matches)
+        if wild and '+' in node:
+            self.walk(node['+'], levels, n + 1, matches)
+
+#############################################################################
+# A received message, kept as text until the script first asks for its
+# content. The network thread then never parses JSON, and a handler that
+# doesn't read the message never pays for parsing it.
+class MQTTMessage():
+    def __init__(self, text):
+        self.text = text
+        self.content = None
+        self.decoded = False
+
+    def getText(self):
+        return self.text
+
+    # Parse the message the first time it is asked for and keep the result
+    def getContent(self):
+        if not self.decoded:
+            try:
+                content = json.loads(self.text)
+            except:
+                content = self.text
+            try:
+                content['message'] = json.loads(content['message']) # type: ignore
+            except:
+                pass
+            self.content = content
+            self.decoded = True
+        return self.content
+
 #############################################################################
 # MQTT client class
 class MQTTClient():
+    MAX_HEADER = 512
+    # Brokers on this machine, such as a LocalBroker, are used without TLS
+    LOCAL_BROKERS = ('localhost', '127.0.0.1', '::1')
+
     def __init__(self):
         super().__init__()
 
@@ -19,14 +90,53 @@ class MQTTClient():
         self.port = port
         self.topics = topics
         self.onConnectPC = None
+        self.connectQueued = False  # Whether the connect handler has been queued
+        self.eventLock = threading.Lock()
+        self.onDisconnectPC = None
         self.onMessagePC = None
-        self.timeout = False
+        self.binaryTopics = TopicTrie()  # Topics whose messages are passed on as bytes
+        self.handlers = TopicTrie()  # The 'on mqtt message from' handler for each topic
         self.messages = {}
-        self.chunked_messages = {}  # Store incoming chunked messages {topic: {part_num: data}}
+        self.partials = {}  # Messages being assembled from chunks, keyed by sender and message ID
+        self.partialTimeout = 30  # Seconds to wait for the missing chunks of a message
+        self.maxMessageSize = 64 * 1048576  # The longest message that will be assembled, in bytes
+        self.lastCollect = 0
+        # Message IDs start at random, so chunks sent before a restart can't
+        # be mistaken for those of a new message with the same ID
+        self.nextMessageID = random.getrandbits(32)
+        self.legacyFraming = False  # Whether to send only the framing that earlier releases read
+        self.inboxes = {}  # Complete messages waiting for each message handler
+        self.inboxLock = threading.Lock()
+        self.capacity = 1000  # The most messages the inbox can hold
+        self.overflow = 'oldest'  # What to do when it is full: drop the 'oldest' or 'newest' message, or 'block'
+        self.dropped = 0
+        self.receivingQoS = 0  # The QoS of the message being received
+        self.heldAcks = []  # Acknowledgements held back while the inbox is full
+        self.message = None
+        self.messageTopic = None
         self.confirmation_lock = threading.Lock()
-        self.chunk_size = 1024  # Default chunk size
+        self.requires = {}
+        self.chunk_size = 16384  # Current chunk size, adjusted to the measured throughput
+        self.minChunkSize = 1024
+        self.maxChunkSize = 16384
+        self.chunkGrowth = 1  # Whether the chunk size is being tried larger (1) or smaller (-1)
+        self.sampleThroughput = None
+        self.maxInFlight = 16  # The most chunks that can be waiting to be acknowledged
+        self.sendTimeout = 30  # Seconds to wait for an acknowledgement before giving up
+        self.published = threading.Condition()
         self.last_send_time = None  # Time taken for last message transmission (seconds)
-        self.connected = False  # Track if we've processed initial connection
+        self.throughput = None  # Bytes per second achieved by the last message
+        self.compressAbove = None  # Compress messages longer than this many bytes, if set
+        self.connected = False  # Whether the client is connected now
+        self.connections = 0  # How many times it has connected
+        self.disconnectedAt = None
+        self.lastOutage = 0  # Seconds the last disconnection lasted
+        self.totalOutage = 0
+        self.sendLock = threading.RLock()
+        self.sender = ThreadPoolExecutor(max_workers=1)  # Sends the script's messages in order
+        self.outbox = deque()  # Messages sent while disconnected, waiting to go
+        self.offlineLimit = 100  # The most messages the outbox can hold
+        self.offlineDropped = 0
         self.client = mqtt.Client(
             client_id=self.clientID,
             callback_api_version=mqtt.CallbackAPIVersion.VERSION2 # type: ignore
@@ -39,163 +149,451 @@ class MQTTClient():
         else:
             if isinstance(self.token, dict):
                 self.client.username_pw_set(self.token['username'], self.token['password'])
-            self.client.tls_set()  # Enable TLS
+            if broker not in self.LOCAL_BROKERS:
+                self.client.tls_set()  # Enable TLS
     
         # Setup callbacks
         self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
         self.client.on_message = self.on_message
+        self.client.on_publish = self.on_publish
+        self.client.max_inflight_messages_set(self.maxInFlight)
 
     def on_connect(self, client, userdata, flags, reason_code, properties):
-        # Only process connection logic once to avoid duplicate subscriptions and handlers
-        if self.connected:
-            # print(f"Client {self.clientID} reconnected (ignored)")
+        # Send chunks as soon as they are published rather than letting the
+        # socket hold them back until earlier ones are acknowledged
+        sock = client.socket()
+        if isinstance(sock, socket.socket):
+            try: sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except OSError: pass
+        if reason_code.is_failure:
+            print(f"Client {self.clientID} failed to connect: {reason_code}")
             return
-            
         self.connected = True
-        print(f"Client {self.clientID} connected")
+        self.connections += 1
+        # Messages held back on the last connection will be sent again
+        self.heldAcks = []
+        first = self.connections == 1
+        if first:
+            print(f"Client {self.clientID} connected")
+        else:
+            self.lastOutage = time.time() - self.disconnectedAt # type: ignore
+            self.totalOutage += self.lastOutage
+            print(f"Client {self.clientID} reconnected after {self.lastOutage:.1f} seconds")
+        # Subscribe every time, as the broker may have started a clean session
         for item in self.topics:
             topic = self.program.getObject(self.program.getVariable(item))
             self.client.subscribe(topic.getName(), qos=topic.getQoS())
-            print(f"Subscribed to topic: {topic.getName().strip()} with QoS {topic.getQoS()}")
+            if first:
+                if topic.isBinary(): self.binaryTopics.add(topic.getName(), True)
+                print(f"Subscribed to topic: {topic.getName().strip()} with QoS {topic.getQoS()}")
+        if self.outbox:
+            threading.Thread(target=self.drainOutbox, daemon=True).start()
+
+        # The connect handler only runs for the first connection
+        if first:
+            self.queueConnect()
+
+    # Set the connect handler. The client starts connecting before the
+    # script gets here, so if it has already connected the handler runs now.
+    def onConnect(self, pc):
+        self.onConnectPC = pc
+        if self.connections > 0:
+            self.queueConnect()
+
+    def queueConnect(self):
+        with self.eventLock:
+            if self.onConnectPC is None or self.connectQueued:
+                return
+            self.connectQueued = True
+        self.program.queueIntent(self.onConnectPC)
+
+    def on_disconnect(self, client, userdata, disconnect_flags, reason_code, properties):
+        if not self.connected:
+            return
+        self.connected = False
+        self.disconnectedAt = time.time()
+        print(f"Client {self.clientID} disconnected: {reason_code}")
+        with self.published:
+            self.published.notify_all()
+        if self.onDisconnectPC is not None:
+            self.program.queueIntent(self.onDisconnectPC)
 
-        if self.onConnectPC is not None:
-            self.program.queueIntent(self.onConnectPC)
+    # Report the state of the connection
+    def getStatus(self):
+        return {
+            'connected': self.connected,
+            'reconnects': max(0, self.connections - 1),
+            'lastOutage': round(self.lastOutage * 1000),
+            'totalOutage': round(self.totalOutage * 1000),
+            'offlineQueued': len(self.outbox),
+            'offlineDropped': self.offlineDropped
+        }
     
     def on_message(self, client, userdata, msg):
-        payload = msg.payload.decode('utf-8', errors='replace')
-        topic = msg.topic
-        
-        # Check if this is a chunked message (format: "!part!<n> <total><data>")
-        if payload.startswith('!part!'):
-            # Extract: "!part!<n> <total><data>"
-            header_end = payload.find(' ', 6)  # Find space after part number
-            if header_end > 6:
-                try:
-                    part_num = int(payload[6:header_end])  # Extract part number
-                    # Find next space to get total_chunks
-                    total_end = payload.find(' ', header_end + 1)
-                    if total_end > header_end:
-                        total_chunks = int(payload[header_end + 1:total_end])
-                        data = payload[total_end + 1:]  # Rest is data
-                        
-                        # Initialize chunked message storage if this is part 0
-                        if part_num == 0:
-                            self.chunked_messages[topic] = {}
-                        
-                        # Store this chunk with its part number
-                        if topic in self.chunked_messages:
-                            self.chunked_messages[topic][part_num] = data
-                            # print(f"Received chunk {part_num}/{total_chunks - 1} on topic {topic}")
-                except (ValueError, IndexError):
-                    pass
+        self.receivingQoS = msg.qos
+        payload = msg.payload
+        if payload.startswith(b'!chunk!'):
+            self.receiveChunk(msg.topic, payload)
+        elif payload.startswith(b'!part!') or payload.startswith(b'!last!'):
+            self.receiveLegacyChunk(msg.topic, payload)
+        elif self.isBinary(msg.topic):
+            # Binary data that wasn't chunked is a message in itself
+            self.completeMessage(msg.topic, payload)
+        self.collectPartials()
+        if self.overflow == 'block' and msg.qos > 0:
+            with self.inboxLock:
+                if self.inboxFull():
+                    self.heldAcks.append((msg.mid, msg.qos))
+                    return
+            self.client.ack(msg.mid, msg.qos)
+
+    # Receive a chunk with the header
+    # "!chunk!<id>/<part>/<total>/<size>/<length>/<flags>/<sender>\n"
+    # where size is the chunk size and length is that of the whole message, both
+    # in bytes as sent, and flags holds 'z' if the message is compressed. Chunks are copied into a buffer of the full length as they arrive,
+    # so they can come in any order and the message is only decoded once.
+    # The buffer is only made if the header describes a message of no more
+    # than the maximum size, in a sensible number of chunks.
+    def receiveChunk(self, topic, payload):
+        end = payload.find(b'\n', 7, 7 + self.MAX_HEADER)
+        if end < 0: return
+        try:
+            msgID, part, total, size, length, flags, sender = payload[7:end].decode('utf-8').split('/', 6)
+            part, total, size, length = int(part), int(total), int(size), int(length)
+        except ValueError:
+            return
+        if length > self.maxMessageSize:
+            print(f'Warning: Discarded a message of {length} bytes from {sender}, which is more than the maximum of {self.maxMessageSize}')
+            return
+        if size <= 0 or length < 0 or total != max(1, (length + size - 1) // size):
+            return
+        data = memoryview(payload)[end + 1:]
+        offset = part * size
+        if part < 0 or part >= total or offset + len(data) > length:
             return
-            
-        elif payload.startswith('!last!'):
-            # Final chunk: "!last!<total><data>"
+        if total == 1:
+            content = self.unpack(data, flags)
+            if content is not None: self.completeMessage(topic, content)
+            return
+        key = (sender, msgID)
+        partial = self.partials.get(key)
+        if partial is None:
+            partial = {
+                'topic': topic,
+                'buffer': bytearray(length),
+                'received': bytearray(total),
+                'flags': flags,
+                'count': 0
+            }
+            self.partials[key] = partial
+        partial['updated'] = time.time()
+        if partial['received'][part]: return # A repeat delivery
+        partial['buffer'][offset:offset + len(data)] = data
+        partial['received'][part] = 1
+        partial['count'] += 1
+        if partial['count'] == len(partial['received']):
+            del self.partials[key]
+            content = self.unpack(partial['buffer'], partial['flags'])
+            if content is not None: self.completeMessage(partial['topic'], content)
+
+    # Undo any compression of a message, which may not expand to more than
+    # the maximum size. Returns None if the message is to be discarded.
+    def unpack(self, data, flags):
+        if 'z' in flags:
             try:
-                # Find where the total ends and data begins (first space after !last!)
-                space_pos = payload.find(' ', 6)
-                if space_pos > 6:
-                    total_chunks = int(payload[6:space_pos])
-                    data = payload[space_pos + 1:]  # Rest is data
-                    
-                    # Initialize topic storage if not present (single chunk case)
-                    if topic not in self.chunked_messages:
-                        self.chunked_messages[topic] = {}
-                    
-                    # Store the last chunk
-                    self.chunked_messages[topic][total_chunks - 1] = data
-                    
-                    # Verify all chunks are present
-                    expected_parts = set(range(total_chunks))
-                    received_parts = set(self.chunked_messages[topic].keys())
-                    
-                    if expected_parts == received_parts:
-                        # All chunks received - assemble complete message
-                        message_parts = [self.chunked_messages[topic][i] for i in sorted(self.chunked_messages[topic].keys())]
-                        complete_message = ''.join(message_parts)
-                        del self.chunked_messages[topic]
-                        
-                        # Confirmation is now handled at the EasyCoder level
-                        # print(f"All chunks received for topic {topic} ({len(complete_message)} bytes total).")
-                        try:
-                            self.message = json.loads(complete_message)
-                        except:
-                            self.message = complete_message
-                        try:
-                            self.message['message'] = json.loads(self.message['message']) # type: ignore
-                        except:
-                            pass
-                        
-                        if self.onMessagePC is not None:
-                            # print(f'Calling onMessagePC callback: {self.onMessagePC}')
-                            self.program.queueIntent(self.onMessagePC)
-                    else:
-                        missing = expected_parts - received_parts
-                        print(f"Warning: Missing chunks {missing} for topic {topic}")
-            except (ValueError, IndexError):
-                pass
+                inflater = zlib.decompressobj()
+                content = inflater.decompress(data, self.maxMessageSize)
+            except zlib.error:
+                print('Warning: Discarded a compressed message that could not be decompressed')
+                return None
+            if inflater.unconsumed_tail:
+                print(f'Warning: Discarded a compressed message that expands to more than the maximum of {self.maxMessageSize} bytes')
+                return None
+            return content
+        return bytes(data)
+
+    # Receive a chunk in the older format, "!part!<n> <total> <data>" or
+    # "!last!<total> <data>", which carries no sender or message ID, so
+    # only one message per topic can be assembled at a time. A first part
+    # starts a new message, discarding any that was incomplete.
+    def receiveLegacyChunk(self, topic, payload):
+        space = payload.find(b' ', 6)
+        if space < 0: return
+        try:
+            if payload.startswith(b'!part!'):
+                part = int(payload[6:space])
+                end = payload.find(b' ', space + 1)
+                if end < 0: return
+                total = int(payload[space + 1:end])
+            else:
+                total = int(payload[6:space])
+                part = total - 1
+                end = space
+        except ValueError:
             return
-    
+        if part < 0 or part >= total:
+            return
+        key = ('', topic)
+        partial = self.partials.get(key)
+        if partial is None or partial['total'] != total or part == 0:
+            partial = {'topic': topic, 'total': total, 'parts': {}, 'length': 0}
+            self.partials[key] = partial
+        partial['updated'] = time.time()
+        data = payload[end + 1:]
+        if part not in partial['parts']:
+            partial['length'] += len(data)
+        if partial['length'] > self.maxMessageSize:
+            del self.partials[key]
+            print(f'Warning: Discarded a message on {topic} that is more than the maximum of {self.maxMessageSize} bytes')
+            return
+        partial['parts'][part] = data
+        if len(partial['parts']) == total and all(n in partial['parts'] for n in range(total)):
+            del self.partials[key]
+            self.completeMessage(topic, b''.join(partial['parts'][n] for n in range(total)))
+
+    # Discard messages that have been waiting too long for their missing chunks
+    def collectPartials(self):
+        now = time.time()
+        if now - self.lastCollect < 1: return
+        self.lastCollect = now
+        for key, partial in list(self.partials.items()):
+            if now - partial['updated'] > self.partialTimeout:
+                del self.partials[key]
+                print(f"Warning: Discarded incomplete message from {key[0] or partial['topic']} after {self.partialTimeout} seconds")
+
+    # Pass a complete message to the script. A message on a binary topic is
+    # passed on as it is; any other is decoded as text, and parsed as JSON
+    # only when the script asks for it.
+    def completeMessage(self, topic, data):
+        if self.isBinary(topic):
+            self.deliver(topic, data)
+            return
+        self.deliver(topic, MQTTMessage(data.decode('utf-8', errors='replace')))
+
+    def isBinary(self, topic):
+        return bool(self.binaryTopics.match(topic))
+
+    # Pass a message to the handlers for its topic, or to the general
+    # message handler if there are none
+    def deliver(self, topic, message):
+        handlers = self.handlers.match(topic)
+        if not handlers and self.onMessagePC is not None:
+            handlers = [self.onMessagePC]
+        if not handlers:
+            self.message = message
+            self.messageTopic = topic
+            return
+        for pc in dict.fromkeys(handlers):
+            self.enqueue(pc, (topic, message))
+
+    # Add a message to the inbox of a handler and queue a run of the handler,
+    # which takes one message each time it runs. When the inbox is full, either
+    # the oldest or the newest message is dropped or, with 'block', messages
+    # at QoS 1 and 2 are kept and their acknowledgements are held back until
+    # the handler makes room. The broker then stops sending once it has as
+    # many unacknowledged messages in flight as it allows. The network thread
+    # never waits, so keepalives and acknowledgements of what this client
+    # sends carry on. Messages at QoS 0 can't be held back, so for them
+    # 'block' drops the oldest.
+    def enqueue(self, pc, item):
+        with self.inboxLock:
+            inbox = self.inboxes.setdefault(pc, deque())
+            held = self.overflow == 'block' and self.receivingQoS > 0
+            if len(inbox) >= self.capacity and not held:
+                self.dropped += 1
+                if self.dropped == 1 or self.dropped % 100 == 0:
+                    print(f'Warning: MQTT inbox full; {self.dropped} message(s) dropped')
+                if self.overflow == 'newest': return
+                inbox.popleft()
+            inbox.append(item)
+        self.program.queueIntent(pc)
+
+    def inboxFull(self):
+        return any(len(inbox) >= self.capacity for inbox in self.inboxes.values())
+
+    # Take the next message from the inbox of a handler, returning False if
+    # there is none
+    def nextMessage(self, pc):
+        with self.inboxLock:
+            inbox = self.inboxes.get(pc)
+            if not inbox: return False
+            self.messageTopic, self.message = inbox.popleft()
+            held = []
+            if self.heldAcks and not self.inboxFull():
+                held, self.heldAcks = self.heldAcks, []
+        # Now there is room, let the broker send more
+        for mid, qos in held:
+            self.client.ack(mid, qos)
+        return True
+
     def getMessageTopic(self):
-        return self.message.topic # type: ignore
+        return self.messageTopic
     
     def getReceivedMessage(self):
+        if isinstance(self.message, MQTTMessage):
+            return self.message.getContent()
         return self.message
 
-    def onMessage(self, pc):
-        self.onMessagePC = pc
+    def onMessage(self, pc, topic=None):
+        if topic is None:
+            self.onMessagePC = pc
+        else:
+            self.handlers.add(topic, pc)
+
+    def on_publish(self, client, userdata, mid, reason_code, properties):
+        with self.published:
+            self.published.notify_all()
+
+    # Send a message, or keep it in the outbox if the client is disconnected
+    # or earlier messages are still waiting to go. When the outbox is full
+    # the oldest message in it is dropped. Returns the reason the message
+    # could not be sent, or None.
+    def sendMessage(self, topic, message, qos, chunk_size=None):
+        with self.sendLock:
+            if self.connected and not self.outbox:
+                return self.transmit(topic, message, qos, chunk_size)
+            if len(self.outbox) >= self.offlineLimit:
+                self.outbox.popleft()
+                self.offlineDropped += 1
+                print(f'Warning: MQTT outbox full; {self.offlineDropped} message(s) dropped')
+            if isinstance(message, bytearray): message = bytes(message)
+            self.outbox.append((topic, message, qos, chunk_size))
+            return None
+
+    # Send a message on the sender thread, which sends one message at a time
+    # in the order they are given, then call onDone with the reason it could
+    # not be sent, or None
+    def sendLater(self, topic, message, qos, onDone):
+        def send():
+            try:
+                error = self.sendMessage(topic, message, qos)
+            except Exception as e:
+                error = str(e)
+            onDone(error)
+        self.sender.submit(send)
+
+    # Send the messages in the outbox, in order, after reconnecting
+    def drainOutbox(self):
+        while self.connected:
+            with self.sendLock:
+                if not self.outbox or not self.connected:
+                    return
+                topic, message, qos, chunk_size = self.outbox.popleft()
+                error = self.transmit(topic, message, qos, chunk_size)
+                if error is not None:
+                    print(f'Warning: A message held while offline could not be sent: {error}')
 
-    def sendMessage(self, topic, message, qos, chunk_size=0):
-        """Send a message, chunking at the UTF-8 byte level.
-        Stores transmission time in self.last_send_time (seconds).
+    def transmit(self, topic, message, qos, chunk_size=None):
+        """Send a message, chunking at the UTF-8 byte level. Bytes are sent as they are.
+        With no chunk size the current adaptive size is used; 0 means don't chunk.
+        Stores transmission time in self.last_send_time (seconds) and the
+        rate achieved in self.throughput (bytes per second). Returns the
+        reason the message could not be sent, or None.
         """
         send_start = time.time()
-        if isinstance(message, bytes):
-            message_str = message.decode('utf-8', errors='replace')
+        if isinstance(message, (bytes, bytearray)):
+            message_bytes = message
         else:
-            message_str = str(message)
-
-        message_bytes = message_str.encode('utf-8')
-        if chunk_size <= 0:
+            message_bytes = str(message).encode('utf-8')
+        flags = ''
+        if self.compressAbove is not None and not self.legacyFraming and len(message_bytes) > self.compressAbove:
+            compressed = zlib.compress(message_bytes)
+            if len(compressed) < len(message_bytes):
+                message_bytes = compressed
+                flags = 'z'
+        adaptive = chunk_size is None
+        if adaptive:
+            chunk_size = self.chunk_size
+        elif chunk_size <= 0: # type: ignore
             chunk_size = len(message_bytes) or 1  # avoid div-by-zero
 
         message_len = len(message_bytes)
-        num_chunks = (message_len + chunk_size - 1) // chunk_size
+        num_chunks = max(1, (message_len + chunk_size - 1) // chunk_size) # type: ignore
 
-        # print(f'Sending message ({message_len} bytes) in {num_chunks} chunks of size {chunk_size} to topic {topic} with QoS {qos}')
-
-        self._send_rapid_fire(topic, message_bytes, qos, chunk_size, num_chunks)
+        error = self._send_windowed(topic, message_bytes, qos, chunk_size, num_chunks, flags)
 
         self.last_send_time = time.time() - send_start
-        # print(f'Message transmission complete in {self.last_send_time:.3f} seconds')
-    
-    def _send_rapid_fire(self, topic, message_bytes, qos, chunk_size, num_chunks):
-        """Send all chunks rapidly; chunking is done on UTF-8 bytes."""
-        # print(f"Sending all {num_chunks} chunks as fast as possible...")
-        for i in range(num_chunks):
-            start = i * chunk_size
-            end = min(start + chunk_size, len(message_bytes))
-            chunk_data = message_bytes[start:end]
+        if self.last_send_time > 0:
+            self.throughput = message_len / self.last_send_time
+        if adaptive and error is None:
+            self.adaptChunkSize(num_chunks)
+        return error
 
-            if i == num_chunks - 1:
-                header = f"!last!{num_chunks} ".encode('ascii')
-            else:
-                header = f"!part!{i} {num_chunks} ".encode('ascii')
+    # Try a larger or smaller chunk size after each message of several chunks,
+    # keeping on in the same direction while the throughput holds up and
+    # turning back when it drops
+    def adaptChunkSize(self, num_chunks):
+        if num_chunks < 4 or self.throughput is None:
+            return
+        if self.sampleThroughput is not None and self.throughput < self.sampleThroughput * 0.8:
+            self.chunkGrowth = -self.chunkGrowth
+        self.sampleThroughput = self.throughput
+        size = self.chunk_size * 2 if self.chunkGrowth > 0 else self.chunk_size // 2
+        self.chunk_size = min(max(size, self.minChunkSize), self.maxChunkSize)
 
-            chunk_msg = header + chunk_data
+    # The header of each chunk of a message. A message in one uncompressed
+    # chunk, and every message when legacy framing is set, has the header
+    # "!part!<n> <total> " or, for the last chunk, "!last!<total> ", which
+    # earlier releases read. Others have the header described at receiveChunk.
+    def chunkHeaders(self, num_chunks, chunk_size, length, flags):
+        if self.legacyFraming or (num_chunks == 1 and not flags):
+            return [(f'!part!{i} {num_chunks} ' if i < num_chunks - 1 else f'!last!{num_chunks} ').encode('ascii')
+                for i in range(num_chunks)]
+        self.nextMessageID = (self.nextMessageID + 1) % (1 << 32)
+        prefix = f'!chunk!{self.nextMessageID}/'
+        suffix = f'/{num_chunks}/{chunk_size}/{length}/{flags}/{self.clientID}\n'
+        return [(prefix + str(i) + suffix).encode('utf-8') for i in range(num_chunks)]
 
-            # Send without waiting
+    def _send_windowed(self, topic, message_bytes, qos, chunk_size, num_chunks, flags=''):
+        """Send the chunks of a message, chunking on UTF-8 bytes, with no more
+        than maxInFlight of them waiting to be acknowledged at any time.
+        Returns the reason if a chunk can't be published or the
+        acknowledgements stop coming, or None.
+        """
+        headers = self.chunkHeaders(num_chunks, chunk_size, len(message_bytes), flags)
+        view = memoryview(message_bytes)
+        window = deque()
+        for i in range(num_chunks):
+            if not self.waitForWindow(window, self.maxInFlight - 1):
+                return f"chunk {i}/{num_chunks - 1} to topic '{topic}' was not acknowledged within {self.sendTimeout} seconds"
+            start = i * chunk_size
+            chunk_msg = headers[i] + view[start:start + chunk_size]
             try:
-                self.client.publish(topic, chunk_msg, qos=qos)
-                # print(f"Sent chunk {i}/{num_chunks - 1} to topic {topic} with QoS {qos}: {len(chunk_msg)} bytes")
+                info = self.client.publish(topic, chunk_msg, qos=qos)
             except Exception as e:
-                print(f"Error publishing chunk {i}/{num_chunks - 1} to topic '{topic}': {e}")
-        # No waiting here; confirmations are handled in EasyCoder using sender identity
+                return f"chunk {i}/{num_chunks - 1} to topic '{topic}' could not be published: {e}"
+            if info.rc != mqtt.MQTT_ERR_SUCCESS and qos == 0:
+                # Nothing will be sent later at QoS 0
+                return f"chunk {i}/{num_chunks - 1} to topic '{topic}' could not be published: {mqtt.error_string(info.rc)}"
+            window.append(info)
+        if not self.waitForWindow(window, 0):
+            return f"the message to topic '{topic}' was not acknowledged within {self.sendTimeout} seconds"
+        return None
+
+    # Wait until no more than a given number of chunks are unacknowledged
+    def waitForWindow(self, window, limit):
+        deadline = time.time() + self.sendTimeout
+        with self.published:
+            while True:
+                # Acknowledgements can arrive out of order
+                for info in list(window):
+                    # A chunk published while not connected can't be tracked;
+                    # it is sent when the connection returns
+                    if info.rc != mqtt.MQTT_ERR_SUCCESS or info.is_published():
+                        window.remove(info)
+                if len(window) <= limit:
+                    return True
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.published.wait(min(remaining, 0.1))
     
-    # Start the MQTT client loop
+    # Start the MQTT client loop. The connection is made in the background and
+    # remade whenever it drops, waiting longer between attempts up to 30 seconds.
     def run(self):
-        self.client.connect(self.broker, int(self.port), 60)
+        self.client.reconnect_delay_set(1, 30)
+        self.client.connect_async(self.broker, int(self.port), 60)
         self.client.loop_start()
         
 ###############################################################################
@@ -212,6 +610,12 @@ class ECTopic(ECObject):
             return ""
         return v['name']
     
+    def isBinary(self):
+        v = self.getValue()
+        if v is None:
+            return False
+        return bool(v.get('binary', False))
+
     def getQoS(self):
         v = self.getValue()
         if v is None:
@@ -224,18 +628,35 @@ class ECTopic(ECObject):
         v = self.getValue()
         if v is None:
             return ""
+        if v.get('binary'):
+            return f'{{"name": "{v["name"]}", "qos": {v["qos"]}, "binary": true}}'
         return f'{{"name": "{v["name"]}", "qos": {v["qos"]}}}'
 
+###############################################################################
+# A named MQTT client, with its own connection, topics and handlers
+class ECMQTTClient(ECObject):
+    def __init__(self):
+        super().__init__()
+        self.client = None
+
+    def setClient(self, client):
+        self.client = client
+
+    def getClient(self):
+        return self.client
+
 ###############################################################################
 ###############################################################################
 # The MQTT compiler and runtime handlers
 class MQTT(Handler):
 
-    MQTT_CLAUSE_KEYWORDS = {'token', 'id', 'broker', 'port', 'subscribe', 'action'}
+    MQTT_CLAUSE_KEYWORDS = {'token', 'id', 'broker', 'port', 'subscribe', 'action', 'queue', 'chunk', 'window', 'compress', 'offline', 'legacy', 'limit'}
 
     def __init__(self, compiler):
         Handler.__init__(self, compiler)
         self.spoke = None
+        self.current = None  # The client whose message is being handled
+        self.sendResults = {}  # The outcome of each send, for its result command
 
     def getName(self):
         return 'mqtt'
@@ -253,10 +674,39 @@ class MQTT(Handler):
         except (ValueError, InvalidToken) as e:
             raise RuntimeError(self.program, 'Invalid encrypted token/secret key or decryption failed') from e
 
+    # Compile an optional client variable, returning its name or None
+    def compileClient(self):
+        if self.peek() not in self.symbols:
+            return None
+        self.nextToken()
+        record = self.getSymbolRecord()
+        self.checkObjectType(self.getObject(record), ECMQTTClient)
+        return record['name']
+
+    # Get the client named in a command, or the default client
+    def getClient(self, command):
+        name = command.get('client')
+        if name is None:
+            if not hasattr(self.program, 'mqttClient'):
+                raise RuntimeError(self.program, 'No MQTT client defined')
+            return self.program.mqttClient
+        client = self.getObject(self.getVariable(name)).getClient()
+        if client is None:
+            raise RuntimeError(self.program, f'MQTT client {name} has not been set up')
+        return client
+
     #############################################################################
     # Keyword handlers
 
-    # init {topic} name {name} qos {qos}
+    # Declare a client variable
+    def k_client(self, command):
+        self.compiler.addValueType()
+        return self.compileVariable(command, 'ECMQTTClient')
+
+    def r_client(self, command):
+        return self.nextPC()
+
+    # init {topic} name {name} qos {qos} [binary]
     def k_init(self, command):
         if self.nextIsSymbol():
             record = self.getSymbolRecord()
@@ -267,6 +717,9 @@ class MQTT(Handler):
             command['name'] = name
             self.skip('qos')
             command['qos'] = self.nextValue()
+            if self.peek() == 'binary':
+                self.nextToken()
+                command['binary'] = True
             self.add(command)
             return True
         return False
@@ -277,13 +730,18 @@ class MQTT(Handler):
         value = {}
         value['name'] = self.textify(command['name'])
         value['qos'] = int(self.textify(command['qos']))
+        if command.get('binary'): value['binary'] = True
         topic.setValue(value)
         record['object'] = topic
         return self.nextPC()
 
-    # mqtt id {clientID} broker {broker} port {port} topics {topic} [and {topic} ...]
+    # mqtt [{client}] id {clientID} broker {broker} port {port} topics {topic} [and {topic} ...]
+    #   [queue {size} [drop oldest/drop newest/block]] [chunk {size}] [window {count}]
+    #   [compress [above {size}]] [offline {count}] [legacy] [limit {size}]
     def k_mqtt(self, command):
         command['requires'] = {}
+        client = self.compileClient()
+        if client is not None: command['client'] = client
         while True:
             token = self.peek()
             if token == 'token':
@@ -322,13 +780,43 @@ class MQTT(Handler):
                         else:
                             break
                 command['requires'][action] = reqList
+            elif token in ('chunk', 'window', 'offline', 'limit'):
+                self.nextToken()
+                command[token] = self.nextValue()
+            elif token == 'compress':
+                self.nextToken()
+                if self.peek() == 'above':
+                    self.nextToken()
+                    command['compress'] = self.nextValue()
+                else:
+                    command['compress'] = ECValue(type=int, content=1024)
+            elif token == 'legacy':
+                # Send only the framing that earlier releases read
+                self.nextToken()
+                command['legacy'] = True
+            elif token == 'queue':
+                self.nextToken()
+                command['queue'] = self.nextValue()
+                if self.peek() == 'drop':
+                    self.nextToken()
+                    overflow = self.nextToken()
+                    if overflow not in ('oldest', 'newest'):
+                        return False
+                    command['overflow'] = overflow
+                elif self.peek() == 'block':
+                    self.nextToken()
+                    command['overflow'] = 'block'
             else:
                 break
         self.add(command)
         return True
 
     def r_mqtt(self, command):
-        if hasattr(self.program, 'mqttClient'):
+        if 'client' in command:
+            holder = self.getObject(self.getVariable(command['client']))
+            if holder.getClient() is not None:
+                raise RuntimeError(self.program, f'MQTT client {command["client"]} already defined')
+        elif hasattr(self.program, 'mqttClient'):
             raise RuntimeError(self.program, 'MQQT client already defined')
         token = self.textify(command['token'])
         broker = self.textify(command['broker'])
@@ -341,22 +829,62 @@ class MQTT(Handler):
         clientID = self.textify(command['clientID'])
         broker = self.textify(command['broker'])
         port = self.textify(command['port'])
-        self.requires = command['requires']
-        topics = command['topics']
+        topics = command.get('topics', [])
         client = MQTTClient()
         client.create(self.program, token, clientID, broker, port, topics)
+        client.requires = command['requires']
+        if 'queue' in command:
+            client.capacity = max(1, int(self.textify(command['queue'])))
+        if 'overflow' in command:
+            client.overflow = command['overflow']
+            if client.overflow == 'block':
+                # Messages are acknowledged once there is room for them
+                client.client.manual_ack_set(True)
+        if 'chunk' in command:
+            # A fixed chunk size, for receivers with small buffers
+            size = max(1, int(self.textify(command['chunk'])))
+            client.chunk_size = client.minChunkSize = client.maxChunkSize = size
+        if 'offline' in command:
+            client.offlineLimit = max(0, int(self.textify(command['offline'])))
+        if 'compress' in command:
+            client.compressAbove = max(0, int(self.textify(command['compress'])))
+        if command.get('legacy'):
+            client.legacyFraming = True
+        if 'limit' in command:
+            client.maxMessageSize = max(1, int(self.textify(command['limit'])))
+        if 'window' in command:
+            client.maxInFlight = max(1, int(self.textify(command['window'])))
+            client.client.max_inflight_messages_set(client.maxInFlight)
         client.run()
-        self.program.mqttClient = client
+        if 'client' in command:
+            holder.setClient(client) # type: ignore
+        else:
+            self.program.mqttClient = client
         return self.nextPC()
 
-    # on mqtt message {action}
+    # on mqtt connect [via {client}] {action}
+    # on mqtt disconnect [via {client}] {action}
+    # on mqtt message [from {topic}] [via {client}] {action}
     def k_on(self, command):
         token = self.peek()
         if token == 'mqtt':
             self.nextToken()
             event = self.nextToken()
-            if event in ['connect', 'message']:
+            if event in ['connect', 'disconnect', 'message']:
                 command['event'] = event
+                if event == 'message' and self.peek() == 'from':
+                    self.nextToken()
+                    if not self.nextIsSymbol():
+                        return False
+                    record = self.getSymbolRecord()
+                    self.checkObjectType(record, ECTopic)
+                    command['topic'] = record['name']
+                if self.peek() == 'via':
+                    self.nextToken()
+                    client = self.compileClient()
+                    if client is None:
+                        return False
+                    command['client'] = client
                 self.nextToken()
                 command['goto'] = 0
                 self.add(command)
@@ -367,6 +895,15 @@ class MQTT(Handler):
                 cmd['goto'] = 0
                 cmd['debug'] = False
                 self.add(cmd)
+                if event == 'message':
+                    # The handler starts by taking the next message from the inbox
+                    cmd = {}
+                    cmd['domain'] = 'mqtt'
+                    cmd['lino'] = command['lino']
+                    cmd['keyword'] = 'nextMessage'
+                    cmd['client'] = command.get('client')
+                    cmd['debug'] = False
+                    self.add(cmd)
                 # Add the action and a 'stop'
                 self.compileOne()
                 cmd = {}
@@ -382,13 +919,26 @@ class MQTT(Handler):
 
     def r_on(self, command):
         event = command['event']
+        client = self.getClient(command)
         if event == 'connect':
-            self.program.mqttClient.onConnectPC = self.nextPC()+1
+            client.onConnect(self.nextPC()+1)
+        elif event == 'disconnect':
+            client.onDisconnectPC = self.nextPC()+1
         elif event == 'message':
-            self.program.mqttClient.onMessagePC = self.nextPC()+1
+            topic = None
+            if 'topic' in command:
+                topic = self.getObject(self.getVariable(command['topic'])).getName()
+            client.onMessage(self.nextPC()+1, topic)
         return command['goto']
 
-    # send {message} to {topic}
+    def r_nextMessage(self, command):
+        client = self.getClient(command)
+        if not client.nextMessage(self.program.pc):
+            return 0
+        self.current = client
+        return self.nextPC()
+
+    # send to {topic} [via {client}] [sender {topic}] [action {action}] [message {message}] [qos {qos}] [or {command}]
     def k_send(self, command):
         if self.nextIs('to'):
             if self.nextIsSymbol():
@@ -397,9 +947,14 @@ class MQTT(Handler):
                 command['to'] = record['name']
                 while True:
                     token = self.peek()
-                    if token in ('sender', 'action', 'message', 'qos'):
+                    if token in ('sender', 'action', 'message', 'qos', 'via'):
                         self.nextToken()
-                        if token == 'sender':
+                        if token == 'via':
+                            client = self.compileClient()
+                            if client is None:
+                                return False
+                            command['client'] = client
+                        elif token == 'sender':
                             if self.nextIsSymbol():
                                 record = self.getSymbolRecord()
                                 self.checkObjectType(record, ECTopic)
@@ -413,6 +968,7 @@ class MQTT(Handler):
                     else:
                         break
                 self.add(command)
+                self.addSendResult(command)
                 return True
 
             command['message'] = self.nextValue()
@@ -433,14 +989,73 @@ class MQTT(Handler):
                         else:
                             break
             self.add(command)
+            self.addSendResult(command)
             return True
         return False
 
+    # Add the internal command that the script resumes at when a message
+    # has been sent, followed by any 'or' clause
+    def addSendResult(self, command):
+        cmd = {}
+        cmd['domain'] = 'mqtt'
+        cmd['lino'] = command['lino']
+        cmd['keyword'] = 'sendResult'
+        cmd['or'] = None
+        cmd['debug'] = False
+        result = self.getCodeSize()
+        self.add(cmd)
+        if self.peek() == 'or':
+            self.nextToken()
+            self.nextToken()
+            # Add a 'goto' to skip the 'or'
+            cmd = {}
+            cmd['domain'] = 'core'
+            cmd['lino'] = command['lino']
+            cmd['keyword'] = 'gotoPC'
+            cmd['goto'] = 0
+            cmd['debug'] = False
+            skip = self.getCodeSize()
+            self.add(cmd)
+            self.getCommandAt(result)['or'] = self.getCodeSize()
+            self.compileOne()
+            self.getCommandAt(skip)['goto'] = self.getCodeSize()
+
+    # Send a message on the client's sender thread, so the script's other
+    # handlers carry on while it waits for acknowledgements, and resume at
+    # the result command. Another handler may take a message meanwhile, so
+    # the one being handled is kept to be put back when the script resumes.
+    def startSend(self, client, topic, message, qos):
+        resume = self.nextPC()
+        results = self.sendResults.setdefault(resume, deque())
+        handling = (self.current, self.current.message, self.current.messageTopic) if self.current is not None else None
+        def onDone(error):
+            results.append((topic, error, handling))
+            self.program.queueIntent(resume)
+        client.sendLater(topic, message, qos, onDone)
+        return None
+
+    # Put back the message being handled and report a send that failed,
+    # running the 'or' clause if there is one
+    def r_sendResult(self, command):
+        topic, error, handling = self.sendResults[self.program.pc].popleft()
+        if handling is not None:
+            self.current, self.current.message, self.current.messageTopic = handling
+        if error is not None:
+            ec_core.errorReason = f'MQTT send to {topic} failed: {error}'
+            if command['or'] is not None:
+                return command['or']
+            print(f'Warning: {ec_core.errorReason}')
+        return self.nextPC()
+
     def r_send(self, command):
-        if not hasattr(self.program, 'mqttClient'):
-            raise RuntimeError(self.program, 'No MQTT client defined')
+        client = self.getClient(command)
         topic = self.getVariable(command['to'])
         qos = int(self.textify(command['qos'])) if 'qos' in command else 1
+        topicObject = self.getObject(topic)
+        if topicObject.isBinary():
+            # Send the message alone, as bytes if that's what it holds
+            message = self.textify(command['message']) if 'message' in command else b''
+            return self.startSend(client, topicObject.getName(), message, qos)
         payload = {}
         payload['sender'] = self.textify(self.getVariable(command['sender'])) if 'sender' in command else None
         action = self.textify(command['action']) if 'action' in command else None
@@ -449,8 +1064,8 @@ class MQTT(Handler):
 #        print('Message: ', payload['message'])
         if action == None:
             raise RuntimeError(self.program, 'MQTT send command missing action field')
-        if action in self.requires:
-            requires = self.requires[action]
+        if action in client.requires:
+            requires = client.requires[action]
             for item in requires:
                 if payload[item] is None:
                     raise RuntimeError(self.program, f'MQTT send command missing required field: {item}')  
@@ -458,10 +1073,7 @@ class MQTT(Handler):
         topicName = topicDict['name']
 #        print(json.dumps(payload))
         # print(f'Sending to topic {topicName} with QoS {qos}: {json.dumps(payload)[:20]}...')
-        self.program.mqttClient.sendMessage(topicName, json.dumps(payload), qos, chunk_size=1024)  
-        if self.program.mqttClient.timeout:
-            return 0
-        return self.nextPC()
+        return self.startSend(client, topicName, json.dumps(payload), qos)
 
     # Declare a topic variable
     def k_topic(self, command):
@@ -486,8 +1098,19 @@ class MQTT(Handler):
         else:
             if token == 'mqtt':
                 token = self.nextToken()
-                if token == 'message':
-                    return ECValue(domain=self.getName(), type='mqtt', content=token)
+                value = None
+                if token in ('message', 'topic', 'throughput', 'status'):
+                    value = ECValue(domain=self.getName(), type='mqtt', content=token)
+                elif token == 'send' and self.nextIs('time'):
+                    value = ECValue(domain=self.getName(), type='mqtt', content='send time')
+                if value is not None and token != 'message' and token != 'topic' and self.peek() == 'of':
+                    # The throughput, send time or status of a named client
+                    self.nextToken()
+                    client = self.compileClient()
+                    if client is None:
+                        return None
+                    value.setProperty('client', client)
+                return value
             # else:
             #     return self.getValue()
         return None
@@ -500,13 +1123,34 @@ class MQTT(Handler):
     #############################################################################
     # Value handlers
 
+    # Get the client a value refers to. The message and its topic come from
+    # the client whose handler is running.
+    def getValueClient(self, v):
+        name = v.getProperty('client')
+        if name is not None:
+            return self.getClient({'client': name})
+        if self.current is not None:
+            return self.current
+        return self.getClient({})
+
     def v_message(self, v):
-        return self.program.mqttClient.message
+        return self.getValueClient(v).getReceivedMessage()
     
     def v_mqtt(self, v):
         content = v.getContent()
+        client = self.getValueClient(v)
         if content == 'message':
-            return self.program.mqttClient.message
+            return client.getReceivedMessage()
+        if content == 'topic':
+            return client.messageTopic
+        if content == 'status':
+            return client.getStatus()
+        if content == 'throughput':
+            # Bytes per second
+            return round(client.throughput) if client.throughput is not None else 0
+        if content == 'send time':
+            # Milliseconds
+            return round(client.last_send_time * 1000) if client.last_send_time is not None else 0
         return None
 
     def v_topic(self, v):
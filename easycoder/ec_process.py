@@ -0,0 +1,91 @@
+import os, signal, subprocess, threading, atexit
+
+__all__ = ['ProcessManager']
+
+###############################################################################
+# Runs operating system commands on worker threads so the interpreter keeps
+# going while they run. Output can be captured, or passed back a line at a
+# time, and a command that runs past its timeout is killed.
+class ProcessManager():
+    def __init__(self):
+        self.processes = set()
+        self.lock = threading.Lock()
+        atexit.register(self.terminateAll)
+
+    def track(self, process):
+        with self.lock:
+            self.processes.add(process)
+
+    def untrack(self, process):
+        with self.lock:
+            self.processes.discard(process)
+
+    # Run a command. When it finishes, onDone is called on the worker thread
+    # with the output, the error output, the exit status and whether it timed
+    # out. The output and error output are only captured if asked for;
+    # otherwise they go where this program's own do. If onLine is given, each
+    # line of output is passed to it as it arrives.
+    def run(self, command, onDone, capture=False, timeout=None, onLine=None, captureErrors=False):
+        def work():
+            pipe = subprocess.PIPE if capture or onLine else None
+            try:
+                # The command gets its own process group so a timeout can kill
+                # everything it started
+                process = subprocess.Popen(command, shell=True, text=True,
+                    stdout=pipe, stderr=subprocess.PIPE if captureErrors else None,
+                    start_new_session=True)
+            except Exception as e:
+                onDone('', str(e), -1, False)
+                return
+            self.track(process)
+            timedOut = threading.Event()
+            def kill():
+                timedOut.set()
+                self.kill(process)
+            timer = None
+            if timeout:
+                timer = threading.Timer(timeout, kill)
+                timer.daemon = True
+                timer.start()
+            errors = []
+            reader = None
+            if captureErrors:
+                # Read the error output alongside, so neither pipe can fill up
+                reader = threading.Thread(target=lambda: errors.append(process.stderr.read()), daemon=True) # type: ignore
+                reader.start()
+            output = ''
+            if onLine:
+                lines = []
+                for line in process.stdout: # type: ignore
+                    line = line.rstrip('\n')
+                    if capture: lines.append(line)
+                    onLine(line)
+                output = '\n'.join(lines)
+            elif capture:
+                output = process.stdout.read() # type: ignore
+            status = process.wait()
+            if reader is not None: reader.join()
+            if timer is not None: timer.cancel()
+            self.untrack(process)
+            onDone(output, ''.join(errors), status, timedOut.is_set())
+        threading.Thread(target=work, daemon=True).start()
+
+    # Start a command that runs on its own. A thread waits for it so it
+    # doesn't linger as a zombie once it exits
+    def background(self, command):
+        process = subprocess.Popen(command, shell=True, start_new_session=True,
+            stdin=subprocess.DEVNULL)
+        threading.Thread(target=process.wait, daemon=True).start()
+        return process
+
+    # Stop any commands that are still running
+    def terminateAll(self):
+        with self.lock:
+            processes = list(self.processes)
+            self.processes.clear()
+        for process in processes:
+            self.kill(process)
+
+    def kill(self, process):
+        try: os.killpg(process.pid, signal.SIGKILL)
+        except OSError: pass
@@ -336,6 +336,7 @@ class Program:
 			elif varType == 'float': value.setValue(type=str, content=str(item))
 			elif varType == 'list': value.setValue(type=list, content=item)
 			elif varType == 'dict': value.setValue(type=dict, content=item)
+			elif varType in ('bytes', 'bytearray'): value.setValue(type='bytes', content=bytes(item))
 			else: value.setValue(type=None, content=None)
 		return value
 	
@@ -363,7 +364,7 @@ class Program:
 			RuntimeError(self, 'Value does not hold a valid ECValue')
 		result = ECValue(type=valType)
 	
-		if valType in ('str', 'int', 'bool', 'list', 'dict', None):
+		if valType in ('str', 'int', 'bool', 'list', 'dict', 'bytes', None):
 			# Simple value - just return the content
 			result.setContent(value.getContent()) # type: ignore
 		
@@ -392,14 +393,14 @@ class Program:
 				
 		elif valType == 'cat':
 			# Handle concatenation
-			content = ''
+			parts = []
 			for part in value.getContent():  # pyright: ignore[reportOptionalMemberAccess]
 				val = self.evaluate(part) # pyright: ignore[reportAttributeAccessIssue]
 				if val != None:
 					if isinstance(val, ECValue): val = str(val.getContent())
 					if val == None: val = ''
-					else: content += str(val)
-			result.setValue(type=str, content=content)
+					else: parts.append(str(val))
+			result.setValue(type=str, content=''.join(parts))
 	
 		else:
 			result = self.textifyInDomain(value)
@@ -0,0 +1,155 @@
+import os, json, stat, tempfile, threading, atexit
+from collections import deque
+from contextlib import contextmanager
+
+__all__ = ['FileSaver']
+
+# Get the process umask. Linux reports it in /proc; elsewhere the only way
+# to read it is to set it and put it back, which is done once, here, when
+# the module is imported and before any files are being written by threads.
+def readUmask():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('Umask:'):
+                    return int(line.split()[1], 8)
+    except (OSError, ValueError):
+        pass
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+# The mode given to new files
+FILE_MODE = 0o666 & ~readUmask()
+
+# Give the path of a new temporary file in the same directory as a target.
+# Once it has been written and the block ends, it is given the target's
+# permissions and renamed over the target. If anything fails it is removed,
+# leaving the target as it was.
+@contextmanager
+def replacing(target):
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(target), prefix='.' + os.path.basename(target) + '.', suffix='.tmp')
+    os.close(fd)
+    try:
+        yield temp
+        # Keep the permissions of the file being replaced
+        try: mode = stat.S_IMODE(os.stat(target).st_mode)
+        except FileNotFoundError: mode = FILE_MODE
+        os.chmod(temp, mode)
+        os.replace(temp, target)
+    except BaseException:
+        try: os.remove(temp)
+        except OSError: pass
+        raise
+
+# Encoders that can be chosen for JSON content by name
+def compactJSON(content):
+    return json.dumps(content, separators=(',', ':'))
+
+def getEncoder(name):
+    if name == 'json':
+        return json.dumps
+    if name == 'compact':
+        return compactJSON
+    if name == 'orjson':
+        import orjson
+        return lambda content: orjson.dumps(content).decode()
+    raise ValueError(f'Unknown encoder "{name}"')
+
+###############################################################################
+# Saves content to local files. Each file is written to a temporary file in
+# the same directory and renamed over the target, so a crash never leaves a
+# partly written file, and can optionally be synced to disk. If a window is
+# set, saves to the same path within the window are merged and only the last
+# is written when the window ends. Content is encoded when it is saved, so
+# later changes to a dictionary or list don't reach the file. A deferred
+# write that fails is kept, to be reported by takeError.
+class FileSaver():
+    def __init__(self, atomic=True, sync=False, window=0, encoder=json.dumps):
+        self.atomic = atomic
+        self.sync = sync
+        self.window = window
+        self.encoder = encoder
+        self.pending = {}
+        self.errors = deque()
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    def configure(self, atomic=None, sync=None, window=None, encoder=None):
+        if atomic is not None: self.atomic = bool(atomic)
+        if sync is not None: self.sync = bool(sync)
+        if window is not None: self.window = float(window)
+        if encoder is not None: self.encoder = encoder
+        if not self.window: self.flush()
+
+    # Convert content to text
+    def encode(self, content):
+        if content is None: return ''
+        if isinstance(content, (dict, list)): return self.encoder(content)
+        if isinstance(content, (bytes, bytearray)): return bytes(content)
+        return content if isinstance(content, str) else str(content)
+
+    # Save content to a path, now or at the end of the window
+    def save(self, path, content):
+        path = str(path)
+        text = self.encode(content)
+        if not self.window:
+            self.write(path, text)
+            return
+        with self.lock:
+            waiting = path in self.pending
+            self.pending[path] = text
+        if not waiting:
+            timer = threading.Timer(self.window, self.flushPath, (path,))
+            timer.daemon = True
+            timer.start()
+
+    def flushPath(self, path):
+        with self.lock:
+            if path not in self.pending: return
+            text = self.pending.pop(path)
+        try:
+            self.write(path, text)
+        except Exception as e:
+            with self.lock:
+                self.errors.append(f'Unable to write to {path}: {e}')
+
+    # Get the reason a deferred write failed, or None if none has
+    def takeError(self):
+        with self.lock:
+            return self.errors.popleft() if self.errors else None
+
+    # Write all the saves that are waiting
+    def flush(self):
+        with self.lock:
+            paths = list(self.pending.keys())
+        for path in paths:
+            self.flushPath(path)
+
+    # Write what is waiting when the program ends. There is no script left to
+    # report failures to, so they are printed.
+    def close(self):
+        self.flush()
+        while self.errors:
+            print(f'Warning: {self.errors.popleft()}')
+
+    def write(self, path, text):
+        target = os.path.realpath(path)
+        if not self.atomic or (os.path.exists(target) and not os.path.isfile(target)):
+            with open(target, 'wb' if isinstance(text, bytes) else 'w') as f:
+                f.write(text)
+                if self.sync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            return
+        with replacing(target) as temp:
+            with open(temp, 'wb' if isinstance(text, bytes) else 'w') as f:
+                f.write(text)
+                if self.sync:
+                    f.flush()
+                    os.fsync(f.fileno())
+        if self.sync:
+            # Make the rename itself durable
+            dirfd = os.open(os.path.dirname(target), os.O_RDONLY)
+            try: os.fsync(dirfd)
+            finally: os.close(dirfd)
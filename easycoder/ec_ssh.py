@@ -0,0 +1,185 @@
+import threading, time, atexit, codecs, paramiko
+
+__all__ = ['SSHPool']
+
+# Read a remote text file in chunks, with read-ahead, decoding as it goes
+def sftpReadText(sftp, path, chunkSize=262144, encoding='utf-8'):
+    decoder = codecs.getincrementaldecoder(encoding)()
+    parts = []
+    with sftp.open(path, 'rb') as remote_file:
+        remote_file.prefetch()
+        while True:
+            chunk = remote_file.read(chunkSize)
+            if not chunk: break
+            parts.append(decoder.decode(chunk))
+    parts.append(decoder.decode(b'', final=True))
+    return ''.join(parts)
+
+# Write text to a remote file in chunks, without waiting for each write
+# to be acknowledged
+def sftpWriteText(sftp, path, text, chunkSize=262144, encoding='utf-8'):
+    with sftp.open(path, 'wb') as remote_file:
+        remote_file.set_pipelined(True)
+        for n in range(0, len(text), chunkSize):
+            remote_file.write(text[n:n + chunkSize].encode(encoding))
+
+###############################################################################
+# A single pooled SSH connection with its SFTP session. The credentials are
+# kept so the connection can be reopened after it drops or is closed for
+# being idle.
+class SSHConnection():
+    def __init__(self, host, port, user, password, timeout=10):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.timeout = timeout
+        self.client = None
+        self.sftp = None
+        self.used = 0
+        self.checked = 0
+        self.active = 0  # How many actions are using the connection now
+        self.lock = threading.Lock()
+
+    def open(self):
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(self.host, port=self.port, username=self.user,
+            password=self.password, timeout=self.timeout)
+        self.client = client
+        self.sftp = client.open_sftp()
+        self.checked = time.time()
+
+    def close(self):
+        if self.sftp is not None:
+            try: self.sftp.close()
+            except Exception: pass
+        if self.client is not None:
+            try: self.client.close()
+            except Exception: pass
+        self.sftp = None
+        self.client = None
+
+    def isAlive(self):
+        if self.client is None: return False
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    # Get the SFTP session, reconnecting if the connection has gone. A
+    # connection that has not been used for a while is probed first.
+    def getSFTP(self, checkInterval):
+        with self.lock:
+            now = time.time()
+            if self.isAlive() and now - self.checked > checkInterval:
+                try:
+                    self.client.get_transport().send_ignore() # type: ignore
+                    self.checked = now
+                except Exception:
+                    self.close()
+            if not self.isAlive():
+                self.close()
+                self.open()
+            self.used = now
+            return self.sftp
+
+    # Get the SFTP session for an action, which must call release when it
+    # has finished, so the connection is not closed while it is in use
+    def acquire(self, checkInterval):
+        sftp = self.getSFTP(checkInterval)
+        with self.lock:
+            self.active += 1
+        return sftp
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+            self.used = time.time()
+
+    # Close the connection if it has been idle for too long
+    def closeIfIdle(self, idleTimeout):
+        with self.lock:
+            if self.client is not None and not self.active and time.time() - self.used > idleTimeout:
+                self.close()
+
+###############################################################################
+# A pool of SSH connections keyed by host, port, user and password, shared by
+# every script so repeated operations on the same server reuse one session.
+# Variables that log in with different passwords get separate connections,
+# so one never closes a connection another is using. Idle connections are
+# closed in the background.
+class SSHPool():
+    def __init__(self, idleTimeout=300, checkInterval=30):
+        self.idleTimeout = idleTimeout
+        self.checkInterval = checkInterval
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.reaper = None
+        self.stopped = threading.Event()
+        atexit.register(self.closeAll)
+
+    # Connect to a server, or reuse the open connection to it, and return
+    # the key of the connection
+    def connect(self, host, user, password, port=22, timeout=10):
+        key = (host, int(port), user, password)
+        with self.lock:
+            connection = self.connections.get(key)
+            if connection is None:
+                connection = SSHConnection(host, int(port), user, password, timeout)
+                self.connections[key] = connection
+            if self.reaper is None:
+                self.reaper = threading.Thread(target=self.reapIdle, daemon=True)
+                self.reaper.start()
+        connection.getSFTP(self.checkInterval)
+        return key
+
+    def getConnection(self, key):
+        if key is None:
+            raise IOError('Not connected to an SSH server')
+        with self.lock:
+            connection = self.connections.get(key)
+        if connection is None:
+            raise IOError(f'No SSH connection to {key[0]}')
+        return connection
+
+    # Get the SFTP session for a connection
+    def getSFTP(self, key):
+        return self.getConnection(key).getSFTP(self.checkInterval)
+
+    # Run an action on the SFTP session of a connection. If checking or
+    # reopening the connection fails, that is tried once more, but once the
+    # action has started it is never repeated, since it may not be safe to
+    # run twice.
+    def call(self, key, action):
+        connection = self.getConnection(key)
+        try:
+            sftp = connection.acquire(self.checkInterval)
+        except Exception:
+            connection.close()
+            sftp = connection.acquire(self.checkInterval)
+        try:
+            return action(sftp)
+        finally:
+            connection.release()
+
+    # Close idle connections every so often until the program ends
+    def reapIdle(self):
+        while not self.stopped.wait(max(1, min(self.idleTimeout / 4, 60))):
+            self.reap()
+
+    # Close connections that have been idle for longer than the timeout
+    def reap(self):
+        with self.lock:
+            connections = list(self.connections.values())
+        for connection in connections:
+            connection.closeIfIdle(self.idleTimeout)
+
+    def closeAll(self):
+        self.stopped.set()
+        with self.lock:
+            connections = list(self.connections.values())
+            self.connections.clear()
+        for connection in connections:
+            connection.close()
+
+# The pool shared by all SSH variables
+sshPool = SSHPool()
@@ -0,0 +1,141 @@
+import os, sys, select, struct, threading, ctypes, ctypes.util
+
+__all__ = ['FileWatcher']
+
+# The inotify events that mean a file has been written, created, replaced or removed
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ONLYDIR = 0x01000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT = struct.Struct('iIII')
+
+# Get the inotify functions from the C library, or None if there aren't any
+def loadInotify():
+    if not sys.platform.startswith('linux'): return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+###############################################################################
+# Watches files and directories and calls back when they change. On Linux this
+# uses inotify, so a change is seen as soon as it happens at no cost in
+# between. Elsewhere it falls back to comparing stat results at intervals.
+# A file is watched through its directory so that a file replaced by a rename
+# is still seen.
+class FileWatcher():
+    def __init__(self, interval=0.5, settle=0.05):
+        self.interval = interval
+        self.settle = settle  # Seconds to gather a burst of events into one
+        self.lock = threading.Lock()
+        self.watches = []
+        self.folders = {}
+        self.fd = None
+        self.thread = None
+        self.libc = loadInotify()
+        if self.libc is not None:
+            fd = self.libc.inotify_init1(os.O_CLOEXEC)
+            if fd >= 0: self.fd = fd
+
+    # Watch a path. For a directory the callback is given the path of the
+    # entry that changed; for a file it is given the path of the file.
+    def watch(self, path, directory, callback):
+        path = os.path.abspath(path)
+        folder = path if directory else os.path.dirname(path)
+        watch = {
+            'path': path,
+            'directory': directory,
+            'callback': callback,
+            'snapshot': self.snapshot(path, directory) if self.fd is None else None
+        }
+        with self.lock:
+            if self.fd is not None:
+                wd = self.libc.inotify_add_watch(self.fd, folder.encode(), WATCH_MASK | IN_ONLYDIR) # type: ignore
+                if wd < 0:
+                    error = ctypes.get_errno()
+                    raise OSError(error, os.strerror(error), folder)
+                self.folders[wd] = folder
+            self.watches.append(watch)
+        if self.thread is None:
+            target = self.readEvents if self.fd is not None else self.poll
+            self.thread = threading.Thread(target=target, daemon=True)
+            self.thread.start()
+
+    # Wait for inotify events and pass them on. A file being appended to
+    # gives an event for every write, so events that follow each other
+    # closely are gathered and each path is reported once.
+    def readEvents(self):
+        while True:
+            select.select([self.fd], [], [])
+            data = os.read(self.fd, 65536) # type: ignore
+            while len(data) < 1048576 and select.select([self.fd], [], [], self.settle)[0]:
+                data += os.read(self.fd, 65536) # type: ignore
+            changed = []
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    # Events were lost, so treat everything as changed
+                    changed.extend(watch['path'] for watch in self.watches)
+                folder = self.folders.get(wd)
+                if folder is None or not name: continue
+                path = os.path.join(folder, name)
+                if path not in changed: changed.append(path)
+            self.dispatch(changed)
+
+    # Tell each watch about the paths that concern it
+    def dispatch(self, changed):
+        with self.lock:
+            watches = list(self.watches)
+        for watch in watches:
+            for path in changed:
+                if watch['directory']:
+                    if path == watch['path'] or os.path.dirname(path) == watch['path']:
+                        watch['callback'](path)
+                elif path == watch['path']:
+                    watch['callback'](path)
+
+    # Record what is needed to see that a path has changed
+    def snapshot(self, path, directory):
+        def state(path):
+            try:
+                info = os.stat(path)
+                return (info.st_mtime_ns, info.st_size, info.st_ino)
+            except OSError:
+                return None
+        if not directory:
+            return state(path)
+        try:
+            with os.scandir(path) as entries:
+                return {entry.path: state(entry.path) for entry in entries}
+        except OSError:
+            return {}
+
+    # Compare snapshots at intervals, when inotify is not available
+    def poll(self):
+        while True:
+            threading.Event().wait(self.interval)
+            with self.lock:
+                watches = list(self.watches)
+            for watch in watches:
+                snapshot = self.snapshot(watch['path'], watch['directory'])
+                previous = watch['snapshot']
+                watch['snapshot'] = snapshot
+                if snapshot == previous: continue
+                if watch['directory']:
+                    for path in sorted(set(snapshot) | set(previous)):
+                        if snapshot.get(path) != previous.get(path):
+                            watch['callback'](path)
+                else:
+                    watch['callback'](watch['path'])
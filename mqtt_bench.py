@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""Benchmark the EasyCoder MQTT client against a local broker.
+
+Measures message rate, payload throughput across chunk sizes and QoS levels,
+reassembly latency and the delay before the interpreter runs a message
+handler, and writes the results as JSON for regression tracking. Everything
+runs on this machine, so no external broker or network is needed.
+
+    python mqtt_bench.py [--quick] [--output results.json]
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from easycoder import LocalBroker, MQTTClient, Program
+from easycoder.ec_mqtt import MQTT
+
+# Stands in for the program an MQTTClient normally belongs to
+class Host():
+    def queueIntent(self, pc):
+        pass
+
+# Connect a client to the local broker, optionally subscribing to a topic.
+# Each complete message received is passed to onMessage.
+def connect(port, name, topic=None, qos=1, onMessage=None):
+    client = MQTTClient()
+    client.create(Host(), '', name, '127.0.0.1', port, [])
+    if onMessage is not None:
+        client.completeMessage = lambda topic, data: onMessage(data)
+    client.run()
+    deadline = time.time() + 10
+    while not client.connected:
+        if time.time() > deadline:
+            raise RuntimeError(f'{name} could not connect to the local broker')
+        time.sleep(0.01)
+    if topic is not None:
+        subscribed = threading.Event()
+        client.client.on_subscribe = lambda *args: subscribed.set()
+        client.client.subscribe(topic, qos=qos)
+        subscribed.wait(5)
+    return client
+
+def percentile(values, fraction):
+    if not values: return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+# Messages per second for a stream of small messages
+def messageRate(port, qos, count, size):
+    received = threading.Semaphore(0)
+    receiver = connect(port, f'rate-rx-{qos}', 'bench/rate', qos, lambda data: received.release())
+    sender = connect(port, f'rate-tx-{qos}')
+    payload = 'x' * size
+    start = time.perf_counter()
+    for _ in range(count):
+        sender.sendMessage('bench/rate', payload, qos)
+    for _ in range(count):
+        if not received.acquire(timeout=30): break
+    elapsed = time.perf_counter() - start
+    receiver.client.disconnect()
+    sender.client.disconnect()
+    return {
+        'qos': qos,
+        'messages': count,
+        'size': size,
+        'seconds': round(elapsed, 4),
+        'messagesPerSecond': round(count / elapsed, 1)
+    }
+
+# Payload throughput for large messages at a given chunk size (None for
+# the adaptive size), and the time taken to assemble each message once its
+# last chunk has arrived
+def throughput(port, qos, chunkSize, size, repeats):
+    done = threading.Semaphore(0)
+    state = {'chunkStart': 0, 'latencies': [], 'ok': True}
+    def onMessage(data):
+        state['latencies'].append(time.perf_counter() - state['chunkStart'])
+        state['ok'] = state['ok'] and len(data) == size
+        done.release()
+    label = 'adaptive' if chunkSize is None else chunkSize
+    receiver = connect(port, f'tp-rx-{qos}-{label}', 'bench/throughput', qos, onMessage)
+    receive = receiver.on_message
+    def timedReceive(client, userdata, msg):
+        state['chunkStart'] = time.perf_counter()
+        receive(client, userdata, msg)
+    receiver.client.on_message = timedReceive
+    sender = connect(port, f'tp-tx-{qos}-{label}')
+    payload = os.urandom(size // 2).hex()
+    rates = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        sender.sendMessage('bench/throughput', payload, qos, chunkSize)
+        if not done.acquire(timeout=60):
+            state['ok'] = False
+            break
+        rates.append(size / (time.perf_counter() - start) / 1e6)
+    receiver.client.disconnect()
+    sender.client.disconnect()
+    latencies = state['latencies']
+    return {
+        'qos': qos,
+        'chunkSize': label,
+        'finalChunkSize': sender.chunk_size if chunkSize is None else chunkSize,
+        'size': size,
+        'repeats': repeats,
+        'complete': state['ok'],
+        'mbPerSecond': round(statistics.median(rates), 3) if rates else None,
+        'bestMbPerSecond': round(max(rates), 3) if rates else None,
+        'reassemblyMs': {
+            'median': ms(statistics.median(latencies)) if latencies else None,
+            'p95': ms(percentile(latencies, 0.95)),
+            'max': ms(max(latencies)) if latencies else None
+        }
+    }
+
+DISPATCH_SCRIPT = '''    script DispatchBench
+
+    use mqtt
+
+    topic Bench
+    variable Message
+
+    init Bench
+        name `bench/dispatch`
+        qos 0
+
+    mqtt
+        token ``
+        id `DispatchBench`
+        broker `127.0.0.1`
+        port {port}
+        subscribe Bench
+
+    on mqtt message put the mqtt message into Message
+    wait {seconds}
+    exit
+'''
+
+# The delay between a message being queued for a script and its handler
+# starting to run in the interpreter
+def dispatchDelay(port, count, interval):
+    queued = []
+    delays = []
+    lock = threading.Lock()
+    enqueue = MQTTClient.enqueue
+    def timedEnqueue(self, pc, item):
+        with lock: queued.append(time.perf_counter())
+        enqueue(self, pc, item)
+    nextMessage = MQTT.r_nextMessage
+    def timedNextMessage(self, command):
+        now = time.perf_counter()
+        with lock:
+            if queued: delays.append(now - queued.pop(0))
+        return nextMessage(self, command)
+    MQTTClient.enqueue = timedEnqueue
+    MQTT.r_nextMessage = timedNextMessage
+
+    def publish():
+        time.sleep(1.5)
+        sender = connect(port, 'dispatch-tx')
+        for n in range(count):
+            sender.sendMessage('bench/dispatch', json.dumps({'n': n}), 0)
+            time.sleep(interval)
+    threading.Thread(target=publish, daemon=True).start()
+    seconds = int(2 + count * interval + 2)
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'dispatch.ecs')
+        with open(path, 'w') as f:
+            f.write(DISPATCH_SCRIPT.format(port=port, seconds=seconds))
+        try:
+            Program(path).start()
+        except SystemExit:
+            pass
+    MQTTClient.enqueue = enqueue
+    MQTT.r_nextMessage = nextMessage
+    return {
+        'messages': count,
+        'handled': len(delays),
+        'intervalMs': ms(interval),
+        'delayMs': {
+            'median': ms(statistics.median(delays)) if delays else None,
+            'p95': ms(percentile(delays, 0.95)),
+            'max': ms(max(delays)) if delays else None
+        }
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the EasyCoder MQTT client against a local broker')
+    parser.add_argument('--quick', action='store_true', help='run fewer and smaller tests')
+    parser.add_argument('--output', help='write the JSON results to this file rather than stdout')
+    parser.add_argument('--skip-dispatch', action='store_true', help="don't measure the interpreter dispatch delay")
+    args = parser.parse_args()
+
+    count = 200 if args.quick else 2000
+    size = 256 * 1024 if args.quick else 1024 * 1024
+    repeats = 2 if args.quick else 5
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'quick': args.quick
+    }
+    broker = LocalBroker().start()
+    # The client reports its connections on stdout, which is kept for the results
+    with contextlib.redirect_stdout(sys.stderr):
+        results['messageRate'] = [messageRate(broker.port, qos, count, 64) for qos in (0, 1, 2)]
+        results['throughput'] = [throughput(broker.port, qos, chunkSize, size, repeats)
+            for qos in (0, 1, 2) for chunkSize in (1024, 4096, 16384, None)]
+        if not args.skip_dispatch:
+            results['dispatch'] = dispatchDelay(broker.port, 50 if args.quick else 200, 0.01)
+        broker.stop()
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
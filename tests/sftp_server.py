@@ -0,0 +1,95 @@
+#!/bin/python3
+
+# A minimal SFTP server for trying out the ssh commands without a real
+# server. It accepts any user and password, serves the files in a temporary
+# folder that starts with hello.txt and a 3 MB big.txt, and prints each
+# operation it is asked to do. The folder is removed when it stops.
+#
+#   python3 sftp_server.py [port]      (the port defaults to 2222)
+#
+# then run sftp.ecs in another terminal.
+
+import atexit, os, shutil, socket, sys, tempfile, threading, paramiko
+from paramiko import SFTPServer, SFTPServerInterface, SFTPAttributes, SFTPHandle, SFTP_OK
+
+ROOT = tempfile.mkdtemp(prefix='ec-sftp-')
+atexit.register(shutil.rmtree, ROOT, True)
+KEY = paramiko.RSAKey.generate(2048)
+
+class Server(paramiko.ServerInterface):
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+class Handle(SFTPHandle):
+    def stat(self):
+        return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+class Files(SFTPServerInterface):
+    def real(self, path):
+        return os.path.join(ROOT, path.lstrip('/'))
+
+    def stat(self, path):
+        print('stat', path, flush=True)
+        try:
+            return SFTPAttributes.from_stat(os.stat(self.real(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        print('open', path, flush=True)
+        try:
+            fd = os.open(self.real(path), flags | getattr(os, 'O_BINARY', 0), 0o644)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_APPEND: mode = 'ab'
+        elif flags & os.O_RDWR: mode = 'r+b'
+        elif flags & os.O_WRONLY: mode = 'wb'
+        else: mode = 'rb'
+        f = os.fdopen(fd, mode)
+        handle = Handle(flags)
+        handle.filename = self.real(path)
+        handle.readfile = f
+        handle.writefile = f
+        return handle
+
+    def remove(self, path):
+        os.remove(self.real(path))
+        return SFTP_OK
+
+    def rename(self, old, new):
+        os.rename(self.real(old), self.real(new))
+        return SFTP_OK
+
+    def posix_rename(self, old, new):
+        os.replace(self.real(old), self.real(new))
+        return SFTP_OK
+
+def serve(sock):
+    transport = paramiko.Transport(sock)
+    transport.add_server_key(KEY)
+    transport.set_subsystem_handler('sftp', paramiko.SFTPServer, Files)
+    transport.start_server(server=Server())
+    print('connection', flush=True)
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 2222
+    with open(os.path.join(ROOT, 'hello.txt'), 'w') as f:
+        f.write('Hello from SFTP')
+    with open(os.path.join(ROOT, 'big.txt'), 'w') as f:
+        f.write('0123456789abcdef\n' * 185000)
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('127.0.0.1', port))
+    server.listen(10)
+    print(f'SFTP server on port {port}, serving {ROOT}', flush=True)
+    while True:
+        sock, _ = server.accept()
+        threading.Thread(target=serve, args=(sock,), daemon=True).start()